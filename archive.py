@@ -0,0 +1,319 @@
+# A replay archive: finished games gathered out of server journals into one
+# file, each game's messages stored together and found through an index, so any
+# game (or any turn of it) can be read without going through the rest:
+#
+#   python archive.py build games.archive games-0.journal games-1.journal
+#   python archive.py scan games.archive
+#   python archive.py show games.archive 1234 --turn 10
+#
+# The archive is read through mmap, with messages unpacked straight out of the
+# mapping as they are iterated over, and never copied out beforehand. The file
+# is laid out as:
+#
+#   HEADER_STRUCT   magic, version, number of games, offset of the index
+#   for each game:
+#       turn table  one offset per turn (TURN_STRUCT), relative to the start
+#                   of the game's messages, just past the PlayerTurn message
+#                   that starts the turn
+#       messages    the game's broadcasts in the tiles wire encoding, as they
+#                   were journalled
+#   index           one INDEX_STRUCT per game, sorted by game id: the game id,
+#                   the offset and length of its messages, and its turns
+#
+# Turns are counted from 0, the first player's first turn, and the board "at" a
+# turn is the board that player was looking at when it started
+
+import argparse
+import mmap
+import os
+import struct
+import time
+
+import journal
+import tiles
+
+
+MAGIC = b'TILESARC'
+VERSION = 1
+
+HEADER_STRUCT = struct.Struct('!8sIIQ')
+INDEX_STRUCT = struct.Struct('!IQII')
+TURN_STRUCT = struct.Struct('!I')
+
+
+# a game's messages and turn table, while the archive is being built
+class Pending():
+    def __init__(self, id):
+        self.game = journal.Game(id)
+        self.messages = bytearray()
+        self.turns = []
+
+    def add(self, msg):
+        turns = self.game.turns
+
+        self.game.apply(msg)
+        self.messages += msg.pack()
+
+        if self.game.turns != turns:
+            self.turns.append(len(self.messages))
+
+
+# gather the games in the given journals into a new archive at path, returning
+# how many games it holds. games still going at the end of the journals are
+# archived as they stand. the archive is written alongside and only moved into
+# place once it is complete, so a failed build leaves nothing behind
+def build(path, journal_paths):
+    partial = path + '.partial'
+    try:
+        count = write_archive(partial, journal_paths)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    os.replace(partial, path)
+    return count
+
+
+def write_archive(path, journal_paths):
+    pending = {}
+    archived = set()
+    index = []
+
+    with open(path, 'wb') as out:
+        # filled in once the index has been written
+        out.write(HEADER_STRUCT.pack(MAGIC, VERSION, 0, 0))
+
+        def write(game):
+            table = b''.join(TURN_STRUCT.pack(offset) for offset in game.turns)
+            out.write(table)
+            index.append((game.game.id, out.tell(), len(game.messages), len(game.turns)))
+            out.write(game.messages)
+            archived.add(game.game.id)
+
+        for journal_path in journal_paths:
+            with open(journal_path, 'rb') as f:
+                data = f.read()
+
+            frames, _ = journal.read_frames(data)
+            for payload in frames:
+                touched = {}
+
+                for id, msg in journal.read_records(payload):
+                    game = pending.get(id)
+                    if game is None:
+                        if id in archived:
+                            if isinstance(msg, tiles.MessageGameStart):
+                                raise ValueError('game {} starts twice, are these journals from different servers?'.format(id))
+                            # nothing is sent once a game is over, but don't
+                            # let a stray message reopen it
+                            continue
+                        game = pending[id] = Pending(id)
+
+                    game.add(msg)
+                    touched[id] = game
+
+                # a frame is a whole event, which can carry on past the end of
+                # a game (say eliminating everyone left in it)
+                for id, game in touched.items():
+                    if game.game.finished():
+                        write(pending.pop(id))
+
+        for id in sorted(pending):
+            write(pending[id])
+
+        index.sort()
+        index_offset = out.tell()
+        for entry in index:
+            out.write(INDEX_STRUCT.pack(*entry))
+
+        out.seek(0)
+        out.write(HEADER_STRUCT.pack(MAGIC, VERSION, len(index), index_offset))
+
+    return len(index)
+
+
+class Archive():
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, self.index_offset = HEADER_STRUCT.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a replay archive'.format(path))
+        if version != VERSION:
+            raise ValueError('{} is a version {} archive, only version {} can be read'.format(
+                path, version, VERSION))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.count
+
+    # (game id, offset, length, turns) for the i-th game, by id
+    def entry(self, i):
+        return INDEX_STRUCT.unpack_from(self.map, self.index_offset + i * INDEX_STRUCT.size)
+
+    # every game id, in order
+    def ids(self):
+        for i in range(self.count):
+            yield self.entry(i)[0]
+
+    # a binary search of the index, where it lies in the file
+    def find(self, id):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self.entry(mid)
+            if entry[0] < id:
+                lo = mid + 1
+            elif entry[0] > id:
+                hi = mid
+            else:
+                return entry
+
+        raise KeyError(id)
+
+    def turns(self, id):
+        return self.find(id)[3]
+
+    # where turn starts, relative to the start of the game's messages
+    def turn_offset(self, entry, turn):
+        _, offset, length, turns = entry
+        if turn < 0:
+            raise ValueError('no turn {}'.format(turn))
+        if turn >= turns:
+            return length
+        return TURN_STRUCT.unpack_from(self.map, offset - (turns - turn) * TURN_STRUCT.size)[0]
+
+    # the game's packed messages, as a view straight into the mapping. release
+    # it before closing the archive
+    def raw(self, id):
+        _, offset, length, _ = self.find(id)
+        return memoryview(self.map)[offset:offset + length]
+
+    # the game's messages, from the start of turn start up to the start of turn
+    # end (the end of the game if None)
+    def messages(self, id, start=None, end=None):
+        entry = self.find(id)
+        offset = entry[1]
+
+        position = offset + (self.turn_offset(entry, start) if start is not None else 0)
+        stop = offset + (self.turn_offset(entry, end) if end is not None else entry[2])
+
+        data = self.map
+        unpack_header = tiles.HEADER_STRUCT.unpack_from
+        unpackers = tiles.MESSAGE_UNPACKERS
+
+        while position < stop:
+            typeint, = unpack_header(data, position)
+            msg, consumed = unpackers[typeint](data, position)
+            yield msg
+            position += consumed
+
+    # the game as it stood when turn started (as it ended if None), with its
+    # board, players and whose turn it is
+    def game_at(self, id, turn=None):
+        game = journal.Game(id)
+        for msg in self.messages(id, end=turn):
+            game.apply(msg)
+        return game
+
+
+# the board as text, a cell per square: the tile id and its rotation, or a dot
+def draw_board(board):
+    lines = ['    ' + ''.join('{:>7}'.format(x) for x in range(board.width))]
+    for y in range(board.height):
+        cells = []
+        for x in range(board.width):
+            tileid, rotation, _ = board.get_tile(x, y)
+            cells.append('{:>7}'.format('.' if tileid is None else '{}/{}'.format(tileid, rotation)))
+        lines.append('{:>4}'.format(y) + ''.join(cells))
+    return '\n'.join(lines)
+
+
+def show(archive, id, turn):
+    game = archive.game_at(id, turn)
+    turns = archive.turns(id)
+
+    print('game {}, {}: players {}, eliminated {}'.format(id,
+        'turn {} of {}'.format(turn, turns) if turn is not None and turn < turns else 'end ({} turns)'.format(turns),
+        game.players, game.eliminated))
+    if not game.finished() and game.current is not None:
+        print('player {} to move'.format(game.current))
+
+    print(draw_board(game.board))
+
+    for idnum, (x, y, position) in sorted(game.board.playerpositions.items()):
+        print('player {} token at {}, {} position {}'.format(idnum, x, y, position))
+
+
+# read every message of every game, as an analytics job would
+def scan(archive):
+    start = time.perf_counter()
+    messages = 0
+    turns = 0
+    winners = 0
+
+    for id in archive.ids():
+        game = journal.Game(id)
+        for msg in archive.messages(id):
+            game.apply(msg)
+            messages += 1
+
+        turns += game.turns
+        if len(game.remaining()) == 1:
+            winners += 1
+
+    elapsed = time.perf_counter() - start
+    print('{} games, {} turns, {} messages, {} won outright'.format(len(archive), turns, messages, winners))
+    print('read in {:.2f}s ({:.0f} games/s, {:.0f} messages/s)'.format(elapsed,
+        len(archive) / elapsed if elapsed > 0 else 0, messages / elapsed if elapsed > 0 else 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and read replay archives of server journals.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='gather journals into a new archive')
+    build_parser.add_argument('archive', help='archive file to write')
+    build_parser.add_argument('journals', nargs='+', help='journal files written by server.py --journal')
+
+    scan_parser = commands.add_parser('scan', help='read every game in an archive')
+    scan_parser.add_argument('archive')
+
+    show_parser = commands.add_parser('show', help='print the board of a game at a turn')
+    show_parser.add_argument('archive')
+    show_parser.add_argument('game', type=int, help='game id')
+    show_parser.add_argument('--turn', type=int, default=None,
+        help='show the board as this turn started (default: as the game ended)')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        try:
+            count = build(args.archive, args.journals)
+        except ValueError as e:
+            parser.error(str(e))
+        print('archived {} games in {:.2f}s'.format(count, time.perf_counter() - start))
+    else:
+        with Archive(args.archive) as archive:
+            if args.command == 'scan':
+                scan(archive)
+            else:
+                try:
+                    show(archive, args.game, args.turn)
+                except KeyError:
+                    parser.error('no game {} in {}'.format(args.game, args.archive))
+                except ValueError as e:
+                    parser.error(str(e))
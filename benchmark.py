@@ -0,0 +1,638 @@
+# Microbenchmarks for the hot paths in tiles.py.
+#
+# Each benchmark times the current code against a copy of the code it
+# replaced, so the speedup can be checked on any machine:
+#
+#   python benchmark.py
+#   python benchmark.py --repeat 7
+#
+# The suite times just the current code on every hot path, for tracking
+# regressions. Save its results from a known good tree, then compare later
+# runs against them (exiting with status 1 if anything got slower):
+#
+#   python benchmark.py --suite --json baseline.json
+#   python benchmark.py --suite --compare baseline.json
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import struct
+import sys
+import time
+import timeit
+
+import tiles
+
+
+# the codec as it was before the precompiled structs and the dispatch table.
+# every call re-parses its format string, and decoding walks an if/elif chain
+
+def legacy_pack_place_tile(msg):
+    return struct.pack('!HHHHHH', tiles.MessageType.PLACE_TILE, msg.idnum,
+        msg.tileid, msg.rotation, msg.x, msg.y)
+
+
+def legacy_pack_move_token(msg):
+    return struct.pack('!HHHHH', tiles.MessageType.MOVE_TOKEN, msg.idnum,
+        msg.x, msg.y, msg.position)
+
+
+def legacy_pack_player_turn(msg):
+    return struct.pack('!HH', tiles.MessageType.PLAYER_TURN, msg.idnum)
+
+
+def legacy_unpack_idnum(cls, bs):
+    messagelen = struct.calcsize('!HH')
+
+    if len(bs) >= messagelen:
+        _, idnum = struct.unpack_from('!HH', bs, 0)
+        return cls(idnum), messagelen
+
+    return None, 0
+
+
+def legacy_unpack_player_joined(bs):
+    headerlen = struct.calcsize('!HHH')
+
+    if len(bs) >= headerlen:
+        _, idnum, namelen = struct.unpack_from('!HHH', bs, 0)
+        if len(bs) >= headerlen + namelen:
+            name, = struct.unpack_from('!{}s'.format(namelen), bs, headerlen)
+            return tiles.MessagePlayerJoined(name, idnum), headerlen + namelen
+
+    return None, 0
+
+
+def legacy_unpack_place_tile(bs):
+    messagelen = struct.calcsize('!HHHHHH')
+
+    if len(bs) >= messagelen:
+        _, idnum, tileid, rotation, x, y = struct.unpack_from('!HHHHHH', bs, 0)
+        return tiles.MessagePlaceTile(idnum, tileid, rotation, x, y), messagelen
+
+    return None, 0
+
+
+def legacy_unpack_move_token(bs):
+    messagelen = struct.calcsize('!HHHHH')
+
+    if len(bs) >= messagelen:
+        _, idnum, x, y, position = struct.unpack_from('!HHHHH', bs, 0)
+        return tiles.MessageMoveToken(idnum, x, y, position), messagelen
+
+    return None, 0
+
+
+def legacy_read_message(bs):
+    MessageType = tiles.MessageType
+
+    msg = None
+    consumed = 0
+
+    typesize = struct.calcsize('!H')
+
+    if len(bs) >= typesize:
+        typeint, = struct.unpack_from('!H', bs, 0)
+
+        if typeint == MessageType.WELCOME:
+            msg, consumed = legacy_unpack_idnum(tiles.MessageWelcome, bs)
+        elif typeint == MessageType.PLAYER_JOINED:
+            msg, consumed = legacy_unpack_player_joined(bs)
+        elif typeint == MessageType.PLAYER_LEFT:
+            msg, consumed = legacy_unpack_idnum(tiles.MessagePlayerLeft, bs)
+        elif typeint == MessageType.COUNTDOWN_STARTED:
+            msg, consumed = tiles.MessageCountdown(), typesize
+        elif typeint == MessageType.GAME_START:
+            msg, consumed = tiles.MessageGameStart(), typesize
+        elif typeint == MessageType.ADD_TILE_TO_HAND:
+            msg, consumed = legacy_unpack_idnum(tiles.MessageAddTileToHand, bs)
+        elif typeint == MessageType.PLAYER_TURN:
+            msg, consumed = legacy_unpack_idnum(tiles.MessagePlayerTurn, bs)
+        elif typeint == MessageType.PLACE_TILE:
+            msg, consumed = legacy_unpack_place_tile(bs)
+        elif typeint == MessageType.MOVE_TOKEN:
+            msg, consumed = legacy_unpack_move_token(bs)
+        elif typeint == MessageType.PLAYER_ELIMINATED:
+            msg, consumed = legacy_unpack_idnum(tiles.MessagePlayerEliminated, bs)
+
+    return msg, consumed
+
+
+# token movement as it was before the lookup tables, stepping through
+# Tile.getmovement and CONNECTION_NEIGHBOURS with a bounds check every square
+
+def legacy_do_player_movement(board, live_idnums):
+    positionupdates = []
+    eliminated = []
+
+    for idnum, playerposition in board.playerpositions.items():
+        if not idnum in live_idnums:
+            continue
+
+        x, y, position = playerposition
+        idx = board.tile_index(x, y)
+        moved = False
+
+        while board.tileids[idx] != None:
+            moved = True
+            tileid = board.tileids[idx]
+            rotation = board.tilerotations[idx]
+            tile = tiles.ALL_TILES[tileid]
+            exitposition = tile.getmovement(rotation, position)
+
+            dx, dy, dposition = tiles.CONNECTION_NEIGHBOURS[exitposition]
+            nx = x + dx
+            ny = y + dy
+
+            if nx < 0 or nx >= tiles.BOARD_WIDTH or ny < 0 or ny >= tiles.BOARD_HEIGHT:
+                position = exitposition
+                eliminated.append(idnum)
+                break
+
+            x, y, position = nx, ny, dposition
+            idx = board.tile_index(x, y)
+
+        if moved:
+            board.update_player_position(idnum, x, y, position)
+            positionupdates.append(tiles.MessageMoveToken(idnum, x, y, position))
+
+    return positionupdates, eliminated
+
+
+# a turn's worth of traffic, in the proportions the server sends it
+def sample_messages(rng, count):
+    msgs = []
+    for _ in range(count):
+        idnum = rng.randrange(tiles.IDNUM_LIMIT)
+        msgs.append(tiles.MessagePlaceTile(idnum, rng.randrange(len(tiles.ALL_TILES)),
+            rng.randrange(4), rng.randrange(tiles.BOARD_WIDTH), rng.randrange(tiles.BOARD_HEIGHT)))
+        msgs.append(tiles.MessageAddTileToHand(rng.randrange(len(tiles.ALL_TILES))))
+        msgs.append(tiles.MessageMoveToken(idnum, rng.randrange(tiles.BOARD_WIDTH),
+            rng.randrange(tiles.BOARD_HEIGHT), rng.randrange(8)))
+        msgs.append(tiles.MessagePlayerTurn(idnum))
+    return msgs
+
+
+def decode_all(read_message, data):
+    view = memoryview(data)
+    offset = 0
+    while True:
+        msg, consumed = read_message(view[offset:])
+        if not consumed:
+            return offset
+        offset += consumed
+
+
+def codec_benchmarks(rng):
+    place = tiles.MessagePlaceTile(3, 7, 2, 0, 4)
+    move = tiles.MessageMoveToken(3, 0, 4, 6)
+    turn = tiles.MessagePlayerTurn(3)
+    out = bytearray(64)
+
+    stream = bytes(tiles.pack_messages(sample_messages(rng, 64)))
+    placed = place.pack()
+
+    return [
+        ('pack PLACE_TILE', lambda: legacy_pack_place_tile(place), place.pack),
+        ('pack MOVE_TOKEN', lambda: legacy_pack_move_token(move), move.pack),
+        ('pack PLAYER_TURN', lambda: legacy_pack_player_turn(turn), turn.pack),
+        ('pack_into PLACE_TILE', lambda: legacy_pack_place_tile(place), lambda: place.pack_into(out, 0)),
+        ('unpack PLACE_TILE', lambda: legacy_read_message(placed), lambda: tiles.read_message_from_bytearray(placed)),
+        ('decode 256 message stream', lambda: decode_all(legacy_read_message, stream),
+            lambda: decode_all(tiles.read_message_from_bytearray, stream)),
+        ('batch decode 256 messages', lambda: decode_all(tiles.read_message_from_bytearray, stream),
+            lambda: tiles.read_messages_from_bytearray(stream)),
+    ]
+
+
+def edge_positions(x, y):
+    positions = []
+    if y == tiles.BOARD_HEIGHT - 1:
+        positions += [0, 1]
+    if x == tiles.BOARD_WIDTH - 1:
+        positions += [2, 3]
+    if y == 0:
+        positions += [4, 5]
+    if x == 0:
+        positions += [6, 7]
+    return positions
+
+
+# a board part way through a random game, caught just after a tile has been
+# placed and before the tokens have been moved. returns
+# (board, live idnums, (x, y) of the tile just placed)
+def random_board(rng, players):
+    edges = [(x, y) for x in range(tiles.BOARD_WIDTH) for y in range(tiles.BOARD_HEIGHT)
+        if edge_positions(x, y)]
+
+    while True:
+        board = tiles.Board()
+        live_idnums = list(range(players))
+        stop = rng.randrange(players, tiles.BOARD_WIDTH * tiles.BOARD_HEIGHT)
+
+        for turn in range(stop + 1):
+            if len(live_idnums) < 2:
+                break
+
+            idnum = live_idnums[turn % len(live_idnums)]
+            tileid = rng.randrange(len(tiles.ALL_TILES))
+            rotation = rng.randrange(4)
+
+            if board.have_player_position(idnum):
+                x, y, _ = board.get_player_position(idnum)
+            else:
+                free = [(x, y) for x, y in edges if board.get_tile(x, y)[0] == None]
+                if not free:
+                    break
+                x, y = rng.choice(free)
+
+            board.set_tile(x, y, tileid, rotation, idnum)
+            if not board.have_player_position(idnum):
+                board.set_player_start_position(idnum, x, y, rng.choice(edge_positions(x, y)))
+
+            if turn == stop:
+                return board, live_idnums, (x, y)
+
+            _, eliminated = board.do_player_movement(live_idnums)
+            live_idnums = [i for i in live_idnums if i not in eliminated]
+
+
+def movement_result(updates, eliminated):
+    return [(msg.idnum, msg.x, msg.y, msg.position) for msg in updates], eliminated
+
+
+# the token positions on a board, so that every timed call can start moving
+# the tokens from the same place. restoring goes through
+# update_player_position so that it costs the same for every kind of board
+def save_tokens(board):
+    return [(idnum,) + board.get_player_position(idnum) for idnum in board.playerpositions]
+
+
+def restore_tokens(board, saved):
+    for idnum, x, y, position in saved:
+        board.update_player_position(idnum, x, y, position)
+
+
+def movement_benchmarks(rng, count):
+    games = [random_board(rng, tiles.PLAYER_LIMIT) for _ in range(count)]
+    starts = [save_tokens(board) for board, _, _ in games]
+
+    compacts = [(tiles.CompactBoard.from_board(board), live_idnums, placed)
+        for board, live_idnums, placed in games]
+    compact_starts = [save_tokens(board) for board, _, _ in compacts]
+
+    # every version has to agree before their timings mean anything
+    for (board, live_idnums, (x, y)), start, (compact, _, _) in zip(games, starts, compacts):
+        expected = movement_result(*legacy_do_player_movement(board, live_idnums))
+
+        restore_tokens(board, start)
+        if movement_result(*board.do_player_movement(live_idnums)) != expected:
+            raise AssertionError('do_player_movement differs from the legacy version')
+
+        # the incremental version only differs in the order it moves tokens
+        # sharing the square
+        restore_tokens(board, start)
+        updates, eliminated = movement_result(*board.do_player_movement_at(x, y, live_idnums))
+        if (sorted(updates), sorted(eliminated)) != (sorted(expected[0]), sorted(expected[1])):
+            raise AssertionError('do_player_movement_at differs from do_player_movement')
+
+        if movement_result(*compact.do_player_movement(live_idnums)) != expected:
+            raise AssertionError('CompactBoard.do_player_movement differs from Board')
+
+        for x in range(tiles.BOARD_WIDTH):
+            for y in range(tiles.BOARD_HEIGHT):
+                if compact.get_tile(x, y) != board.get_tile(x, y):
+                    raise AssertionError('CompactBoard.get_tile differs from Board')
+
+    # every call moves the tokens on all of the boards, after restore_all has
+    # put them back at their start positions
+    def move_all(do_player_movement, games=games):
+        for board, live_idnums, _ in games:
+            do_player_movement(board, live_idnums)
+
+    def move_all_at(games=games):
+        for board, live_idnums, (x, y) in games:
+            board.do_player_movement_at(x, y, live_idnums)
+
+    def restore_all(games=games, starts=starts):
+        for (board, _, _), start in zip(games, starts):
+            restore_tokens(board, start)
+
+    tile = tiles.ALL_TILES[7]
+
+    return [
+        ('tile exit lookup', lambda: tile.getmovement(3, 5),
+            lambda: tiles.TILE_EXITS[(7*4 + 3%4)*8 + 5]),
+        ('move tokens, {} boards'.format(count), lambda: move_all(legacy_do_player_movement),
+            lambda: move_all(tiles.Board.do_player_movement), restore_all, restore_all),
+        ('move tokens, {} compact boards'.format(count), lambda: move_all(tiles.Board.do_player_movement),
+            lambda: move_all(tiles.CompactBoard.do_player_movement, compacts),
+            restore_all, lambda: restore_all(compacts, compact_starts)),
+        ('move placed square, {} boards'.format(count), lambda: move_all(tiles.Board.do_player_movement),
+            move_all_at, restore_all, restore_all),
+    ]
+
+
+# a random game's board with extra tokens spread over its empty squares, for
+# seeing how movement scales with the number of tokens
+def crowded_board(rng, tokens):
+    board, live_idnums, (x, y) = random_board(rng, tiles.PLAYER_LIMIT)
+
+    # the square the tile was just placed on was empty until then too
+    empty = [(ex, ey) for ex in range(tiles.BOARD_WIDTH) for ey in range(tiles.BOARD_HEIGHT)
+        if board.get_tile(ex, ey)[0] == None or (ex, ey) == (x, y)]
+
+    live_idnums = set(live_idnums)
+    for idnum in range(tiles.PLAYER_LIMIT, tiles.PLAYER_LIMIT + tokens):
+        ex, ey = rng.choice(empty)
+        board.update_player_position(idnum, ex, ey, rng.randrange(8))
+        live_idnums.add(idnum)
+
+    return board, live_idnums, (x, y)
+
+
+def crowded_benchmarks(rng, tokens):
+    board, live_idnums, (x, y) = crowded_board(rng, tokens)
+
+    # only the tokens on the placed square move, so only they need putting back
+    start = [token for token in save_tokens(board) if token[1:3] == (x, y)]
+
+    def move():
+        board.do_player_movement(live_idnums)
+
+    def move_at():
+        board.do_player_movement_at(x, y, live_idnums)
+
+    def restore():
+        restore_tokens(board, start)
+
+    return [
+        ('move placed square, {} tokens'.format(tokens), move, move_at, restore, restore),
+    ]
+
+
+# copying a Board field by field, as a bot had to before CompactBoard.copy
+def clone_board(board):
+    clone = tiles.Board()
+    clone.tileids = board.tileids[:]
+    clone.tilerotations = board.tilerotations[:]
+    clone.tileplaceids = board.tileplaceids[:]
+    clone.playerpositions = board.playerpositions.copy()
+    return clone
+
+
+def board_benchmarks(rng):
+    board, _, _ = random_board(rng, tiles.PLAYER_LIMIT)
+    compact = tiles.CompactBoard.from_board(board)
+
+    return [
+        ('clone board', lambda: clone_board(board), compact.copy),
+    ]
+
+
+# every tiles.py hot path on its own, for the suite. inputs come from rng, so
+# a seed always gives the same ones
+def suite_benchmarks(rng, count):
+    benchmarks = []
+
+    # one of each message the server sends, and a stream of a turn's traffic
+    msgs = [
+        tiles.MessageWelcome(3),
+        tiles.MessagePlayerJoined('127.0.0.1:30021', 3),
+        tiles.MessagePlayerLeft(3),
+        tiles.MessageCountdown(),
+        tiles.MessageGameStart(),
+        tiles.MessageAddTileToHand(7),
+        tiles.MessagePlayerTurn(3),
+        tiles.MessagePlaceTile(3, 7, 2, 0, 4),
+        tiles.MessageMoveToken(3, 0, 4, 6),
+        tiles.MessagePlayerEliminated(3),
+    ]
+
+    for msg in msgs:
+        name = tiles.MessageType(tiles.HEADER_STRUCT.unpack_from(msg.pack())[0]).name
+        packed = bytes(msg.pack())
+        benchmarks.append(('pack ' + name, msg.pack))
+        benchmarks.append(('read_message_from_bytearray ' + name,
+            lambda packed=packed: tiles.read_message_from_bytearray(packed)))
+
+    stream = bytes(tiles.pack_messages(sample_messages(rng, 64)))
+    benchmarks.append(('read_messages_from_bytearray 256 messages',
+        lambda: tiles.read_messages_from_bytearray(stream)))
+
+    tile = tiles.ALL_TILES[rng.randrange(len(tiles.ALL_TILES))]
+    benchmarks.append(('Tile.getmovement, all 32 exits',
+        lambda: [tile.getmovement(rotation, position) for rotation in range(4) for position in range(8)]))
+
+    # placing the last tile of each random game again, after taking it off
+    games = [random_board(rng, tiles.PLAYER_LIMIT) for _ in range(count)]
+    placed = [(board, x, y) + board.get_tile(x, y) for board, _, (x, y) in games]
+
+    def clear_placed():
+        for board, x, y, _, _, _ in placed:
+            idx = board.tile_index(x, y)
+            board.tileids[idx] = None
+            board.tilerotations[idx] = None
+            board.tileplaceids[idx] = None
+
+    def set_placed():
+        for board, x, y, tileid, rotation, idnum in placed:
+            board.set_tile(x, y, tileid, rotation, idnum)
+
+    benchmarks.append(('Board.set_tile, {} boards'.format(count), set_placed, clear_placed))
+
+    starts = [save_tokens(board) for board, _, _ in games]
+
+    def restore_all():
+        for (board, _, _), start in zip(games, starts):
+            restore_tokens(board, start)
+
+    def move_all():
+        for board, live_idnums, _ in games:
+            board.do_player_movement(live_idnums)
+
+    def move_all_at():
+        for board, live_idnums, (x, y) in games:
+            board.do_player_movement_at(x, y, live_idnums)
+
+    benchmarks.append(('Board.do_player_movement, {} boards'.format(count), move_all, restore_all))
+    benchmarks.append(('Board.do_player_movement_at, {} boards'.format(count), move_all_at, restore_all))
+
+    return benchmarks
+
+
+# enough calls per timing for it to take at least 0.2 seconds. setup, if given,
+# is called before every call to put its inputs back, and isn't timed
+def calls_per_timing(func, setup=None):
+    if setup is None:
+        number, _ = timeit.Timer(func).autorange()
+        return number
+
+    setup()
+    start = time.perf_counter()
+    func()
+    return max(1, int(0.2 / max(time.perf_counter() - start, 1e-9)))
+
+
+# the time a single call takes, averaged over number calls
+def time_calls(func, number, setup=None):
+    if setup is None:
+        return timeit.Timer(func).timeit(number) / number
+
+    # timing one call at a time so the setup can go in between
+    total = 0
+    for _ in range(number):
+        setup()
+        start = time.perf_counter()
+        func()
+        total += time.perf_counter() - start
+    return total / number
+
+
+# the time a single call takes, from each of `repeat` timings
+def time_samples(func, repeat, setup=None):
+    number = calls_per_timing(func, setup)
+    return [time_calls(func, number, setup) for _ in range(repeat)]
+
+
+def best_time(func, repeat, setup=None):
+    return min(time_samples(func, repeat, setup))
+
+
+def run(benchmarks, repeat):
+    print('{:<32} {:>12} {:>12} {:>8}'.format('benchmark', 'before (ns)', 'after (ns)', 'speedup'))
+
+    for name, before, after, *setup in benchmarks:
+        # some benchmarks have to reset their inputs before every call, and
+        # give the before and after resets
+        before_setup, after_setup = setup or (None, None)
+
+        before_ns = best_time(before, repeat, before_setup) * 1e9
+        after_ns = best_time(after, repeat, after_setup) * 1e9
+
+
+        print('{:<32} {:>12.0f} {:>12.0f} {:>7.2f}x'.format(name, before_ns, after_ns, before_ns / after_ns))
+
+
+# time every benchmark in the suite, returning the results as they are saved
+# to json: statistics in nanoseconds per call for each benchmark, and what they
+# were measured on
+def run_suite(benchmarks, repeat, seed):
+    results = {}
+
+    # some benchmarks have to reset their inputs before every call, which is
+    # done outside the timings
+    timed = [(name, func, setup[0] if setup else None) for name, func, *setup in benchmarks]
+    numbers = [calls_per_timing(func, setup) for _, func, setup in timed]
+
+    # a round of timings takes one of each benchmark, so that a benchmark's
+    # timings are spread over the whole run and not all caught by the same
+    # spell of the machine being busy
+    timings = {name: [] for name, _, _ in timed}
+    for _ in range(repeat):
+        for (name, func, setup), number in zip(timed, numbers):
+            timings[name].append(time_calls(func, number, setup) * 1e9)
+
+    print('{:<48} {:>10} {:>10} {:>10} {:>8}'.format('benchmark', 'min (ns)', 'median', 'mean', 'stdev'))
+
+    for name, samples in timings.items():
+        stats = {
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'mean': statistics.mean(samples),
+            'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            'samples': samples,
+        }
+        results[name] = stats
+
+        print('{:<48} {:>10.0f} {:>10.0f} {:>10.0f} {:>7.1f}%'.format(name, stats['min'], stats['median'],
+            stats['mean'], 100 * stats['stdev'] / stats['mean'] if stats['mean'] else 0))
+
+    return {
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'repeat': repeat,
+        'benchmarks': results,
+    }
+
+
+# compare the suite's results against a baseline saved from an earlier run,
+# returning the names of the benchmarks that are more than threshold (a
+# fraction) slower. the median timings are compared, and a change only counts
+# if it also takes every timing past the other run's, so a benchmark that just
+# happened to be noisy isn't flagged
+def compare_suite(results, baseline, threshold):
+    if baseline['seed'] != results['seed']:
+        print('warning: baseline was run with seed {}, not {}'.format(baseline['seed'], results['seed']))
+    if baseline['python'] != results['python'] or baseline['platform'] != results['platform']:
+        print('warning: baseline was run on {}, {}'.format(baseline['python'], baseline['platform']))
+
+    print()
+    print('{:<48} {:>10} {:>10} {:>8}'.format('benchmark', 'base (ns)', 'now (ns)', 'change'))
+
+    regressions = []
+
+    for name, stats in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            print('{:<48} {:>10} {:>10.0f}'.format(name, '-', stats['median']))
+            continue
+
+        change = stats['median'] / base['median'] - 1
+        verdict = ''
+        if change > threshold and min(stats['samples']) > max(base['samples']):
+            verdict = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold and max(stats['samples']) < min(base['samples']):
+            verdict = '  faster'
+
+        print('{:<48} {:>10.0f} {:>10.0f} {:>+7.1f}%{}'.format(name, base['median'], stats['median'], 100 * change, verdict))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmarks for tiles.py.')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='timings per benchmark, the best one is reported (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=3002,
+        help='seed for the generated inputs (default: %(default)s)')
+    parser.add_argument('--boards', type=int, default=1000,
+        help='random boards per movement benchmark call (default: %(default)s)')
+    parser.add_argument('--tokens', type=int, default=1000,
+        help='tokens on the board for the crowded movement benchmark (default: %(default)s)')
+    parser.add_argument('--suite', action='store_true',
+        help='time the current hot paths on their own instead of against the code they replaced')
+    parser.add_argument('--json', metavar='FILE',
+        help='save the suite results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+        help='compare the suite results against a baseline saved with --json')
+    parser.add_argument('--threshold', type=float, default=10,
+        help='percent slower than the baseline that counts as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    if args.suite or args.json or args.compare:
+        results = run_suite(suite_benchmarks(rng, args.boards), args.repeat, args.seed)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+
+            regressions = compare_suite(results, baseline, args.threshold / 100)
+            if regressions:
+                print('{} benchmark(s) regressed by more than {}%'.format(len(regressions), args.threshold))
+                sys.exit(1)
+
+        sys.exit(0)
+
+    run(codec_benchmarks(rng) + movement_benchmarks(rng, args.boards) + crowded_benchmarks(rng, args.tokens)
+        + board_benchmarks(rng), args.repeat)
@@ -0,0 +1,172 @@
+# Bots that choose moves for players, used by the server when a player runs out
+# of time on their turn.
+#
+# A bot has two methods, called with the game as it stands:
+#
+#   choose_tile_move(board, idnum, hand, live_idnums) -> (tileid, rotation, x, y)
+#   choose_start_position(board, idnum, live_idnums) -> (x, y, position)
+#
+# returning None if the player has no legal move. choose_move() calls the right
+# one for the phase of the player's turn, and is what the server runs in its
+# process pool, so bots have to be picklable.
+
+import math
+import random
+import time
+
+import tiles
+
+
+# the two kinds of turn a bot can be asked to play
+PLACE_TILE = 'tile'
+START_TOKEN = 'start'
+
+
+def choose_move(bot, phase, board, idnum, hand, live_idnums):
+    if phase == START_TOKEN:
+        return bot.choose_start_position(board, idnum, live_idnums)
+
+    return bot.choose_tile_move(board, idnum, hand, live_idnums)
+
+
+# picks a random legal move, avoiding any that would eliminate the player
+# unless there is nothing else
+class RandomBot():
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def choose_tile_move(self, board, idnum, hand, live_idnums):
+        move = self.pick(board.legal_tile_moves(idnum, hand))
+        return move and move[:4]
+
+    def choose_start_position(self, board, idnum, live_idnums):
+        move = self.pick(board.legal_start_positions(idnum))
+        return move and move[:3]
+
+    def pick(self, moves):
+        return pick_safe(self.rng, moves) if moves else None
+
+
+# flat Monte-Carlo search: every candidate move is played out on copies of the
+# board with random games to the end (or `depth` turns), sharing out the
+# playouts between the candidates with UCB1, until the time budget runs out.
+# the move played out most often is chosen.
+#
+# a playout scores 1 if the player wins, 1/n if they are one of n players still
+# in the game at the end of it, and 0 if they are eliminated
+class RolloutBot():
+    def __init__(self, budget=0.5, depth=40, exploration=1.4, seed=None):
+        self.budget = budget
+        self.depth = depth
+        self.exploration = exploration
+
+        # every search starts from this seed, or a fresh one if it is None (a
+        # bot sent to a worker process is a copy, so its own rng state would
+        # repeat on every move)
+        self.seed = seed
+        self.rng = None
+
+    def choose_tile_move(self, board, idnum, hand, live_idnums):
+        board = compact_board(board)
+        moves = [move[:4] for move in board.legal_tile_moves(idnum, hand)]
+
+        def play(board, move):
+            tileid, rotation, x, y = move
+            board.set_tile(x, y, tileid, rotation, idnum)
+
+        return self.search(board, idnum, live_idnums, moves, play)
+
+    def choose_start_position(self, board, idnum, live_idnums):
+        board = compact_board(board)
+        moves = [move[:3] for move in board.legal_start_positions(idnum)]
+
+        def play(board, move):
+            x, y, position = move
+            board.set_player_start_position(idnum, x, y, position)
+
+        return self.search(board, idnum, live_idnums, moves, play)
+
+    def search(self, board, idnum, live_idnums, moves, play):
+        if len(moves) <= 1:
+            return moves[0] if moves else None
+
+        deadline = time.monotonic() + self.budget
+        self.rng = random.Random(self.seed)
+
+        visits = [0] * len(moves)
+        scores = [0.0] * len(moves)
+        total = 0
+
+        while time.monotonic() < deadline:
+            if total < len(moves):
+                i = total
+            else:
+                logtotal = math.log(total)
+                i = max(range(len(moves)), key=lambda i: scores[i] / visits[i]
+                    + self.exploration * math.sqrt(logtotal / visits[i]))
+
+            playout = board.copy()
+            play(playout, moves[i])
+
+            visits[i] += 1
+            scores[i] += self.playout(playout, idnum, live_idnums)
+            total += 1
+
+        return moves[max(range(len(moves)), key=lambda i: (visits[i], scores[i]))]
+
+    # move the tokens after the player's move, then play random turns for
+    # everyone, returning the player's score
+    def playout(self, board, idnum, live_idnums):
+        rng = self.rng
+        live = list(live_idnums)
+
+        # the turn order from the player after this one, round to this one
+        i = live.index(idnum)
+        order = live[i+1:] + live[:i+1]
+        turns = 0
+
+        while True:
+            _, eliminated = board.do_player_movement(live)
+            if eliminated:
+                live = [player for player in live if player not in eliminated]
+
+            if idnum not in live:
+                return 0.0
+            if len(live) == 1 or turns == self.depth:
+                return 1.0 / len(live)
+
+            player = order[turns % len(order)]
+            turns += 1
+
+            if player not in live:
+                continue
+
+            if not board.have_player_position(player) and player in board.placeids:
+                moves = board.legal_start_positions(player)
+                if moves:
+                    x, y, position, _ = pick_safe(rng, moves)
+                    board.set_player_start_position(player, x, y, position)
+            else:
+                hand = [rng.randrange(len(tiles.ALL_TILES)) for _ in range(tiles.HAND_SIZE)]
+                moves = board.legal_tile_moves(player, hand)
+                if not moves:
+                    return 1.0 / len(live)
+                tileid, rotation, x, y, _ = pick_safe(rng, moves)
+                board.set_tile(x, y, tileid, rotation, player)
+
+
+def pick_safe(rng, moves):
+    safe = [move for move in moves if not move[-1]]
+    return rng.choice(safe or moves)
+
+
+def compact_board(board):
+    if isinstance(board, tiles.CompactBoard):
+        return board
+    return tiles.CompactBoard.from_board(board)
+
+
+BOTS = {
+    'random': RandomBot,
+    'rollout': RolloutBot,
+}
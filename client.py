@@ -337,99 +337,89 @@ def add_tile_to_hand(tileid):
   app.event_generate("<<RedrawHand>>")
 
 def communication_thread(sock):
-  buffer = bytearray()
+  reader = tiles.MessageReader()
 
   while True:
     try:
-      chunk = sock.recv(4096)
-      if chunk:
-        # Read a chunk from the socket, and add it to the end of our buffer
-        # (in case we had a partial message in the buffer from a previous
-        # chunk, and we need the new chunk to complete it)
-        buffer.extend(chunk)
-
+      # Read a chunk from the socket into the end of our buffer (in case we
+      # had a partial message in the buffer from a previous chunk, and we need
+      # the new chunk to complete it)
+      if reader.recv(sock):
         # Unpack as many messages as we can from the buffer.
-        while True:
-          msg, consumed = tiles.read_message_from_bytearray(buffer)
-
-          if consumed:
-            buffer = buffer[consumed:]
-
-            if isinstance(msg, tiles.MessageWelcome):
-              print('Welcome!')
-              with app.infolock:
-                app.idnum = msg.idnum
-                app.playernames[app.idnum] = 'Me!'
+        for msg in reader.read_messages():
+          if isinstance(msg, tiles.MessageWelcome):
+            print('Welcome!')
+            with app.infolock:
+              app.idnum = msg.idnum
+              app.playernames[app.idnum] = 'Me!'
 
-            elif isinstance(msg, tiles.MessagePlayerJoined):
-              print('Player {} joined, id {}'.format(msg.name, msg.idnum))
-              with app.infolock:
-                app.playernames[msg.idnum] = msg.name
+          elif isinstance(msg, tiles.MessagePlayerJoined):
+            print('Player {} joined, id {}'.format(msg.name, msg.idnum))
+            with app.infolock:
+              app.playernames[msg.idnum] = msg.name
 
-            elif isinstance(msg, tiles.MessagePlayerLeft):
-              print('Player id {} left'.format(msg.idnum))
-              with app.infolock:
-                if msg.idnum in app.playernames:
-                  del app.playernames[msg.idnum]
-                else:
-                  print("...I didn't know they were a player!")
+          elif isinstance(msg, tiles.MessagePlayerLeft):
+            print('Player id {} left'.format(msg.idnum))
+            with app.infolock:
+              if msg.idnum in app.playernames:
+                del app.playernames[msg.idnum]
+              else:
+                print("...I didn't know they were a player!")
 
-            elif isinstance(msg, tiles.MessageCountdown):
-              print('Countdown starting...')
+          elif isinstance(msg, tiles.MessageCountdown):
+            print('Countdown starting...')
 
-            elif isinstance(msg, tiles.MessageGameStart):
-              print('Game starting...')
-              reset_game_state()
+          elif isinstance(msg, tiles.MessageGameStart):
+            print('Game starting...')
+            reset_game_state()
 
-            elif isinstance(msg, tiles.MessageAddTileToHand):
-              print('Add tile {} to hand'.format(msg.tileid))
-              tileid = msg.tileid
+          elif isinstance(msg, tiles.MessageAddTileToHand):
+            print('Add tile {} to hand'.format(msg.tileid))
+            tileid = msg.tileid
 
-              if tileid < 0 or tileid >= len(tiles.ALL_TILES):
-                raise RuntimeError('Unknown tile index {}'.format(tileid))
+            if tileid < 0 or tileid >= len(tiles.ALL_TILES):
+              raise RuntimeError('Unknown tile index {}'.format(tileid))
 
-              add_tile_to_hand(tileid)
+            add_tile_to_hand(tileid)
 
-            elif isinstance(msg, tiles.MessagePlayerTurn):
-              print('Player turn: {}'.format(msg))
+          elif isinstance(msg, tiles.MessagePlayerTurn):
+            print('Player turn: {}'.format(msg))
 
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
 
-              set_player_turn(msg.idnum)
+            set_player_turn(msg.idnum)
 
-            elif isinstance(msg, tiles.MessagePlaceTile):
-              print('Place tile: {}'.format(msg))
+          elif isinstance(msg, tiles.MessagePlaceTile):
+            print('Place tile: {}'.format(msg))
 
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
 
-              tile_placed(msg)
+            tile_placed(msg)
 
-            elif isinstance(msg, tiles.MessageMoveToken):
-              print('Move token: {}'.format(msg))
+          elif isinstance(msg, tiles.MessageMoveToken):
+            print('Move token: {}'.format(msg))
 
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
 
-              token_moved(msg)
+            token_moved(msg)
 
-            elif isinstance(msg, tiles.MessagePlayerEliminated):
-              print('Player eliminated: {}'.format(msg))
+          elif isinstance(msg, tiles.MessagePlayerEliminated):
+            print('Player eliminated: {}'.format(msg))
 
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
 
-              set_player_eliminated(msg.idnum)
+            set_player_eliminated(msg.idnum)
 
-            else:
-              print('Unknown message: {}'.format(msg))
           else:
-            break
+            print('Unknown message: {}'.format(msg))
       else:
         break
     except Exception as e:
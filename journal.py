@@ -0,0 +1,255 @@
+# An append-only journal of every game the server runs, so games can be
+# replayed afterwards and the server can pick up where it left off after a
+# crash:
+#
+#   python server.py --journal games.journal
+#   python journal.py games.journal
+#
+# What is journalled is each game's broadcasts, the same packed messages every
+# player and spectator was sent: the start, the turn order, tiles placed,
+# tokens moved, eliminations and whose turn it is. Replaying them the way a
+# client would rebuilds the game's board.
+#
+# The file is a run of frames, one per event the server handled:
+#
+#   FRAME_STRUCT    length and crc32 of the payload
+#   payload         records, each a game id (RECORD_STRUCT) followed by one
+#                   message in the tiles wire encoding
+#
+# A frame only counts once all of it has made it to disk with the right
+# checksum, so a frame torn by a crash is dropped on recovery, along with
+# everything after it
+
+import argparse
+import os
+import struct
+import time
+import zlib
+
+import tiles
+
+
+FRAME_STRUCT = struct.Struct('!II')
+RECORD_STRUCT = struct.Struct('!I')
+
+# when the journal is fsynced: after every commit, every so often (see sync),
+# or whenever the OS gets round to it
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+# a game as far as its journal records have taken it
+class Game():
+    def __init__(self, id):
+        self.id = id
+        self.board = tiles.Board()
+
+        # everyone who started the game, in the first turn order
+        self.players = []
+        self.eliminated = []
+
+        self.current = None
+        self.tiles_placed = 0
+
+        # turns given out so far, counting the one in progress
+        self.turns = 0
+
+    def remaining(self):
+        return [id for id in self.players if id not in self.eliminated]
+
+    # over once at most one player is left, same as the server's rule. the
+    # players are only all known once the first turn has been given out
+    def finished(self):
+        return self.current is not None and len(self.remaining()) <= 1
+
+    def apply(self, msg):
+        if isinstance(msg, tiles.MessageGameStart):
+            self.__init__(self.id)
+
+        elif isinstance(msg, tiles.MessagePlayerTurn):
+            # the start sends the whole turn order, then whose turn it is,
+            # which repeats the first player
+            if msg.idnum not in self.players and self.current is None:
+                self.players.append(msg.idnum)
+            else:
+                self.turns += 1
+                self.current = msg.idnum
+
+        elif isinstance(msg, tiles.MessagePlaceTile):
+            idx = self.board.tile_index(msg.x, msg.y)
+            self.board.tileids[idx] = msg.tileid
+            self.board.tilerotations[idx] = msg.rotation
+            self.board.tileplaceids[idx] = msg.idnum
+            self.tiles_placed += 1
+
+        elif isinstance(msg, tiles.MessageMoveToken):
+            self.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
+
+        elif isinstance(msg, tiles.MessagePlayerEliminated):
+            if msg.idnum not in self.eliminated:
+                self.eliminated.append(msg.idnum)
+
+
+# the payload of each complete frame in data, and the offset just past the
+# last of them. anything after that offset is a torn or corrupt frame
+def read_frames(data):
+    frames = []
+    offset = 0
+    end = len(data)
+
+    while end - offset >= FRAME_STRUCT.size:
+        length, crc = FRAME_STRUCT.unpack_from(data, offset)
+        start = offset + FRAME_STRUCT.size
+        if end - start < length:
+            break
+
+        payload = data[start:start + length]
+        if zlib.crc32(payload) != crc:
+            break
+
+        frames.append(payload)
+        offset = start + length
+
+    return frames, offset
+
+
+# (game id, message) for each record in a frame's payload
+def read_records(payload):
+    records = []
+    offset = 0
+    end = len(payload)
+    unpackers = tiles.MESSAGE_UNPACKERS
+
+    while offset < end:
+        # a record is at least a game id and a message header, any less and
+        # it was cut short the same as a truncated message
+        if end - offset < RECORD_STRUCT.size + tiles.HEADER_STRUCT.size:
+            raise ValueError('torn record at the end of a journal frame')
+
+        game, = RECORD_STRUCT.unpack_from(payload, offset)
+        offset += RECORD_STRUCT.size
+
+        typeint, = tiles.HEADER_STRUCT.unpack_from(payload, offset)
+        unpack = unpackers.get(typeint)
+        if unpack is None:
+            raise ValueError('unknown message type {} in journal record for game {}'.format(typeint, game))
+
+        msg, consumed = unpack(payload, offset)
+        if not consumed:
+            raise ValueError('truncated message in journal record for game {}'.format(game))
+
+        records.append((game, msg))
+        offset += consumed
+
+    return records
+
+
+# replay the journal at path, returning every game in it by id, and the length
+# of the journal that could be read
+def recover(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}, 0
+
+    frames, end = read_frames(data)
+
+    games = {}
+    for payload in frames:
+        for id, msg in read_records(payload):
+            game = games.get(id)
+            if game is None:
+                game = games[id] = Game(id)
+            game.apply(msg)
+
+    return games, end
+
+
+# appends to the journal at path, dropping anything past end (the torn tail
+# left by a crash, as found by recover). records are gathered up and written
+# out together by commit, one frame and one write for everything an event
+# produced
+class Journal():
+    def __init__(self, path, fsync='interval', end=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy {!r}'.format(fsync))
+
+        self.path = path
+        self.fsync = fsync
+        self.pending = bytearray()
+        self.unsynced = False
+
+        # bytes of torn frames thrown away
+        self.dropped = 0
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.fd).st_size
+        if end is not None and size > end:
+            os.ftruncate(self.fd, end)
+            self.dropped = size - end
+
+    def record(self, game, msg):
+        self.pending += RECORD_STRUCT.pack(game)
+        self.pending += msg
+
+    def commit(self):
+        if not self.pending:
+            return
+
+        payload, self.pending = self.pending, bytearray()
+        os.write(self.fd, FRAME_STRUCT.pack(len(payload), zlib.crc32(payload)) + payload)
+
+        if self.fsync == 'always':
+            os.fsync(self.fd)
+        else:
+            self.unsynced = True
+
+    # fsync whatever has been committed since the last one, for the interval
+    # policy
+    def sync(self):
+        if self.unsynced and self.fsync != 'never':
+            os.fsync(self.fd)
+            self.unsynced = False
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        self.commit()
+        if self.unsynced:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+
+def describe(game):
+    if not game.finished():
+        outcome = 'interrupted'
+    elif len(game.remaining()) == 1:
+        outcome = 'won by {}'.format(game.remaining()[0])
+    else:
+        outcome = 'no winner'
+
+    return 'game {}: players {}, {} turns, {} tiles, {}'.format(
+        game.id, game.players, game.turns, game.tiles_placed, outcome)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise the games in a server journal.')
+    parser.add_argument('journal', help='journal file written by server.py --journal')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        games, end = recover(args.journal)
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+
+    for id in sorted(games):
+        print(describe(games[id]))
+
+    size = os.path.getsize(args.journal)
+    print('{} games replayed from {} bytes in {:.2f}s'.format(len(games), end, elapsed))
+    if size > end:
+        print('{} bytes at the end are torn and will be dropped'.format(size - end))
@@ -0,0 +1,292 @@
+# Headless load generator for capacity planning.
+#
+# Connects thousands of simulated players to a running server, all on a single
+# asyncio loop, and has each of them play random moves (chosen the same way as
+# tester.py's clients) whenever it is their turn. While it runs, and once more
+# at the end, it reports turn latency percentiles, message rates and connection
+# failures:
+#
+#   python server.py --mode events &
+#   python loadgen.py --clients 2000 --duration 60
+#
+# a player's turn latency is the time from sending its move until the server
+# sends the move back to it
+
+import argparse
+import asyncio
+import random
+import time
+
+import metrics
+import tester
+import tiles
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# everything the simulated players have seen so far
+class Stats():
+    def __init__(self):
+        self.connected = 0
+
+        # connections that couldn't be made, and connections the server closed
+        # while the run was still going
+        self.failed = 0
+        self.dropped = 0
+
+        self.messages = 0
+        self.bytes = 0
+        self.moves = 0
+
+        # turn latencies over the whole run, and since the last progress
+        # report. histograms, so a long run doesn't hold on to every one
+        self.latency = latency_histogram()
+        self.recent_latency = latency_histogram()
+
+
+def latency_histogram():
+    return metrics.Histogram('loadgen_turn_latency_seconds',
+        'Time from sending a move until the server sent it back.')
+
+
+# one client, keeping track of just enough of its game to make moves
+class SimulatedPlayer(asyncio.Protocol):
+    def __init__(self, stats, think):
+        self.stats = stats
+        self.think = think
+        self.transport = None
+        self.closing = False
+        self.buffer = bytearray()
+
+        self.idnum = None
+        self.board = tiles.Board()
+        self.hand = []
+
+        # whether the server's last turn message was for this player, and
+        # whether its move for that turn has already been scheduled
+        self.my_turn = False
+        self.moving = False
+
+        # when the move went out, until the server sends it back
+        self.sent_at = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if not self.closing:
+            self.stats.dropped += 1
+
+    def close(self):
+        self.closing = True
+        if self.transport is not None:
+            self.transport.close()
+
+    def data_received(self, data):
+        self.buffer += data
+        msgs, consumed = tiles.read_messages_from_bytearray(self.buffer)
+        del self.buffer[:consumed]
+
+        self.stats.messages += len(msgs)
+        self.stats.bytes += len(data)
+
+        for msg in msgs:
+            self.handle_message(msg)
+
+        # only the last turn message in a chunk counts, the server sends the
+        # whole turn order before whose turn it actually is
+        if self.my_turn and not self.moving:
+            self.moving = True
+            if self.think > 0:
+                asyncio.get_running_loop().call_later(self.think, self.take_turn)
+            else:
+                self.take_turn()
+
+    def handle_message(self, msg):
+        if isinstance(msg, tiles.MessageWelcome):
+            self.idnum = msg.idnum
+
+        elif isinstance(msg, tiles.MessageGameStart):
+            self.board.reset()
+            self.hand.clear()
+            self.my_turn = False
+            self.moving = False
+            self.sent_at = None
+
+        elif isinstance(msg, tiles.MessageAddTileToHand):
+            self.hand.append(msg.tileid)
+
+        elif isinstance(msg, tiles.MessagePlayerTurn):
+            self.my_turn = msg.idnum == self.idnum
+            if not self.my_turn:
+                self.moving = False
+                self.sent_at = None
+
+        # spectators (who are never dealt a hand) don't need to follow the
+        # board, they are sent a fresh one if they join a game
+        elif not self.hand:
+            return
+
+        elif isinstance(msg, tiles.MessagePlaceTile):
+            idx = self.board.tile_index(msg.x, msg.y)
+            self.board.tileids[idx] = msg.tileid
+            self.board.tilerotations[idx] = msg.rotation
+            self.board.tileplaceids[idx] = msg.idnum
+
+            if msg.idnum == self.idnum:
+                if msg.tileid in self.hand:
+                    self.hand.remove(msg.tileid)
+                self.move_answered()
+
+        elif isinstance(msg, tiles.MessageMoveToken):
+            self.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
+
+            if msg.idnum == self.idnum:
+                self.move_answered()
+
+        elif isinstance(msg, tiles.MessagePlayerEliminated):
+            if msg.idnum == self.idnum:
+                self.my_turn = False
+
+    def move_answered(self):
+        if self.sent_at is not None:
+            latency = time.perf_counter() - self.sent_at
+            self.stats.latency.observe(latency)
+            self.stats.recent_latency.observe(latency)
+            self.sent_at = None
+
+    def take_turn(self):
+        if self.transport is None or not self.my_turn or not self.hand:
+            return
+
+        try:
+            msg = tester.choose_turn(self.board, self.idnum, self.hand)
+        except RuntimeError:
+            # nowhere left to start, the server will time the turn out
+            return
+
+        self.transport.write(msg.pack())
+        self.sent_at = time.perf_counter()
+        self.stats.moves += 1
+
+
+def latency_summary(histogram):
+    return 'p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+        *(seconds * 1000 for seconds in (histogram.quantile(0.5), histogram.quantile(0.9),
+            histogram.quantile(0.99), histogram.max)))
+
+
+# print what happened since the last report
+def report_progress(stats, elapsed, last, interval):
+    messages, moves = last
+
+    print('{:6.1f}s  connected {}  failed {}  dropped {}  msgs/s {:.0f}  moves/s {:.1f}  latency (ms) {}'.format(
+        elapsed, stats.connected, stats.failed, stats.dropped,
+        (stats.messages - messages) / interval, (stats.moves - moves) / interval,
+        latency_summary(stats.recent_latency)))
+
+    stats.recent_latency = latency_histogram()
+    return stats.messages, stats.moves
+
+
+def report(stats, elapsed):
+    print()
+    print('clients: {} connected, {} failed, {} dropped by the server'.format(
+        stats.connected, stats.failed, stats.dropped))
+    print('messages: {} received in {:.1f}s ({:.0f}/s, {:.1f} KB/s)'.format(
+        stats.messages, elapsed, stats.messages / elapsed, stats.bytes / elapsed / 1024))
+    print('moves: {} sent ({:.1f}/s)'.format(stats.moves, stats.moves / elapsed))
+    print('turn latency (ms) over {} turns: {}'.format(stats.latency.count, latency_summary(stats.latency)))
+
+
+async def connect(stats, args, players):
+    loop = asyncio.get_running_loop()
+
+    try:
+        _, player = await asyncio.wait_for(
+            loop.create_connection(lambda: SimulatedPlayer(stats, args.think), args.host, args.port),
+            args.connect_timeout)
+    except (OSError, asyncio.TimeoutError):
+        stats.failed += 1
+        return
+
+    stats.connected += 1
+    players.append(player)
+
+
+async def generate_load(args, stats):
+    players = []
+    start = time.perf_counter()
+
+    # connect args.rate clients a second (or all at once), reporting as we go
+    async def ramp_up():
+        connecting = []
+        for _ in range(args.clients):
+            connecting.append(asyncio.ensure_future(connect(stats, args, players)))
+            if args.rate > 0:
+                await asyncio.sleep(1 / args.rate)
+        await asyncio.gather(*connecting)
+
+    ramp = asyncio.ensure_future(ramp_up())
+
+    last = (0, 0)
+    last_time = start
+    deadline = start + args.duration
+    while last_time < deadline:
+        await asyncio.sleep(min(args.interval, deadline - last_time))
+
+        now = time.perf_counter()
+        last = report_progress(stats, now - start, last, now - last_time)
+        last_time = now
+
+    ramp.cancel()
+    elapsed = time.perf_counter() - start
+
+    for player in players:
+        player.close()
+
+    return elapsed
+
+
+# each simulated player needs a file descriptor
+def raise_file_limit():
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive simulated players against a running server.')
+    parser.add_argument('--host', default='127.0.0.1',
+        help='server address (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=30020,
+        help='server port (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=1000,
+        help='simulated players to connect (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=200,
+        help='new connections per second, 0 for all at once (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=30,
+        help='seconds to run for, including the ramp up (default: %(default)s)')
+    parser.add_argument('--think', type=float, default=0,
+        help='seconds each player waits before making its move (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=5,
+        help='seconds between progress reports (default: %(default)s)')
+    parser.add_argument('--connect-timeout', type=float, default=10,
+        help='seconds to wait for a connection (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=None,
+        help='seed for the random moves')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    raise_file_limit()
+
+    stats = Stats()
+    elapsed = asyncio.run(generate_load(args, stats))
+    report(stats, elapsed)
@@ -0,0 +1,216 @@
+# Counters, gauges and latency histograms for the server, and a small HTTP
+# endpoint serving them in the Prometheus text format:
+#
+#   python server.py --metrics-port 9020 &
+#   curl http://127.0.0.1:9020/metrics
+#
+# Recording is meant to be cheap enough to leave on everywhere: a counter is an
+# integer add, and a histogram a few integer operations to find its bucket.
+# Metrics are only ever updated from one thread (the server's actor), and read
+# from the endpoint's thread without any locking, so a scrape can be off by the
+# odd update in flight
+
+import http.server
+import math
+import threading
+
+
+class Counter():
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} counter'.format(self.name),
+            '{} {}'.format(self.name, self.value),
+        ]
+
+
+# a counter for each value of a label, e.g. messages by type. describe turns a
+# key into the label's value when rendering, so recording can use whatever key
+# is cheapest to hand
+class CounterFamily():
+    def __init__(self, name, help, label, describe=str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.describe = describe
+        self.values = {}
+
+    def inc(self, key, amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} counter'.format(self.name),
+        ]
+        for label, value in sorted((self.describe(key), value) for key, value in list(self.values.items())):
+            lines.append('{}{{{}="{}"}} {}'.format(self.name, self.label, label, value))
+        return lines
+
+
+# a value read when the metrics are rendered
+class Gauge():
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} gauge'.format(self.name),
+            '{} {}'.format(self.name, self.read()),
+        ]
+
+
+# durations in seconds, counted in log-linear buckets of microseconds, as in an
+# HDR histogram: every power of two is split into 2**SUB_BUCKET_BITS buckets,
+# so a bucket is never more than 1/16th wider than the values in it, and the
+# whole range from a microsecond to days needs only a few hundred of them
+class Histogram():
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.counts = []
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        micros = int(seconds * 1e6)
+        if micros < 0:
+            micros = 0
+
+        # values below 2*SUB_BUCKETS get a bucket each, above that the top
+        # SUB_BUCKET_BITS+1 bits pick the bucket
+        shift = micros.bit_length() - self.SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            index = micros
+        else:
+            index = shift * self.SUB_BUCKETS + (micros >> shift)
+
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+
+    # the middle of a bucket's range, in seconds
+    def bucket_value(self, index):
+        if index < 2 * self.SUB_BUCKETS:
+            return index / 1e6
+
+        shift = index // self.SUB_BUCKETS - 1
+        mantissa = index - shift * self.SUB_BUCKETS
+        return ((mantissa << shift) + (1 << shift) / 2) / 1e6
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        target = max(1, math.ceil(self.count * q))
+        seen = 0
+        for index, count in enumerate(list(self.counts)):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_value(index), self.max)
+
+        return self.max
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} summary'.format(self.name),
+        ]
+        for q in self.QUANTILES:
+            lines.append('{}{{quantile="{}"}} {:.6f}'.format(self.name, q, self.quantile(q)))
+        lines.append('{}_sum {:.6f}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def counter_family(self, name, help, label, describe=str):
+        return self.add(CounterFamily(name, help, label, describe))
+
+    def gauge(self, name, help, read):
+        return self.add(Gauge(name, help, read))
+
+    def histogram(self, name, help):
+        return self.add(Histogram(name, help))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    # the headline numbers, for logging: every counter and gauge, and the
+    # median and 99th percentile of every histogram
+    def summary(self):
+        summary = {}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    summary[metric.name + '_p50'] = round(metric.quantile(0.5), 6)
+                    summary[metric.name + '_p99'] = round(metric.quantile(0.99), 6)
+            elif isinstance(metric, CounterFamily):
+                summary[metric.name] = sum(metric.values.values())
+            elif isinstance(metric, Gauge):
+                summary[metric.name] = metric.read()
+            else:
+                summary[metric.name] = metric.value
+        return summary
+
+
+# serve the registry at /metrics on a background thread. only ever bound to
+# localhost, the numbers aren't for the outside world
+def serve_http(registry, port, host='127.0.0.1'):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # scrapes aren't worth a line each
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -15,12 +15,28 @@
 # there are enough players available the server will start a new game with a
 # new selection of clients.
 
+import argparse
+import bots
+import concurrent.futures
+import enum
+import heapq
+import journal
+import json
+import logging
+import logging.handlers
+import metrics
+import multiprocessing
+import os
+import queue
+import selectors
+import signal
 import socket
 import sys
 import tiles
 import threading
+import time
+import tracing
 import random
-import signal
 
 # countdown time in seconds before a game starts
 countdown = 0
@@ -28,522 +44,1713 @@ countdown = 0
 # time each player has to make a move
 timeout = 10
 
+# most bytes that can be waiting to go out to a client that isn't reading
+# before it is cut off. spectators are dropped sooner than players in a game
+player_backlog = 256 * 1024
+spectator_backlog = 64 * 1024
 
-# global variables used for game
-turn_index = 0
-turn_order = []
+# clients only ever send a few small messages, so their receive buffers can
+# start small (they grow if they ever need to)
+recv_buffer_size = 512
 
-board = tiles.Board()
-placements = []
-current_tokens = []
-players_eliminated = []
+# lets the threaded server try a send without blocking the caller
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
 
-players = {}
-players_remaining = []
+# the bot that plays for players who run out of time, and the worker processes
+# it runs in. without a pool, fallback_bot picks a move straight away
+bot = None
+bot_pool = None
+bot_workers = None
+fallback_bot = bots.RandomBot()
 
-playerno = 0
+# how much longer than the bot's own budget to wait for its move (it may be
+# queued behind other games) before making a fallback_bot move instead
+bot_grace = 0.25
 
 
-# send a message to all clients connected to the server
-def send_to_all(msg):
-    for key in players:
-        key.send(msg)
+# most per-message log lines written each second, the rest are counted and
+# the count is added to the next line that is written
+log_messages_per_second = 20
 
-# send a message to all clients except specified client
-def send_to_others(msg, current_con):
-    for key in players:
-        if key is not current_con:
-            key.send(msg)
 
-# clear the variables associated with a client on disconnection
-def disconnect_player(connection, id):
-    if len(players) == 1:
-        players_remaining.clear()
-        turn_order.clear()
-        players.clear()
-    else:
-        if id in players_remaining:
-            players_remaining.remove(id)
-
-        if id in turn_order:
-            turn_order.remove(id)
-
-        del players[connection]
-
-# check to see if the game should finish, and if a new game should start
-def check_game_over(con):
-    global in_progress
-
-    if len(players_remaining) == 1 and len(players) >= 2:
-        #Game has finished, new game needed
-        signal.alarm(0)
-        print('Game Over, starting new game...')
-        in_progress = True
-        turn_order.clear()
-        placements.clear()
-        start_game()
-        return True
+##------------------------------------------------------------##
+# Logging: everything the server reports goes through `log`, as an event name
+# and fields (extra=fields(...)). records are put on a queue and formatted and
+# written out by a background thread, so nothing logged waits on stdout.
+# per-message lines go to `message_log` at DEBUG, and are only built at all
+# when log_each_message is set
 
-    elif len(players_remaining) == 1:
-        signal.alarm(0)
-        print('Game over')
-        turn_order.clear()
-        placements.clear()
-        in_progress = False
-        return True
+log = logging.getLogger('server')
+message_log = log.getChild('messages')
 
-    return False
+# whether message_log will write anything, checked before building each line
+log_each_message = False
 
+log_format = 'text'
+log_listener = None
 
 
+def fields(**kwargs):
+    return {'fields': kwargs}
 
 
-def tile_place(msg, con, idnum):
-    if board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum):
-        send_to_all(msg.pack())
+# event key=value key=value ...
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = '{} {:<7} {}'.format(self.formatTime(record), record.levelname, record.getMessage())
 
-        # add tile place to placement history
-        tile_msg = [msg.idnum, msg.tileid, msg.rotation, msg.x, msg.y]
-        placements.append(tile_msg)
+        for key, value in getattr(record, 'fields', {}).items():
+            line += ' {}={}'.format(key, value)
 
-        # check for token movement
-        positionupdates, eliminated = board.do_player_movement(players_remaining)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
 
-        # pickup a new tile and remove placed tile from hand
-        players[con].hand.remove(msg.tileid)
-        new_tileid = tiles.get_random_tileid()
-        players[con].hand.append(new_tileid)
-        con.send(tiles.MessageAddTileToHand(new_tileid).pack())
+        return line
 
-        for msg in positionupdates:
-          send_to_all(msg.pack())
 
-          # record up to date position of token
-          token_msg = [msg.idnum, msg.x, msg.y, msg.position]
-          current_tokens.append(token_msg)
+# one json object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
 
-        # check for resulting eliminated players
-        for id in players_remaining:
-            if id in eliminated and id not in players_eliminated:
-              # let all clients know this client has been eliminated
-              send_to_all(tiles.MessagePlayerEliminated(id).pack())
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
 
-              # remove eliminated client from players remaining, add to players eliminated
-              players_remaining.remove(id)
-              players_eliminated.append(id)
+        return json.dumps(entry, default=str)
 
-              if id in turn_order:
-                  with lock:
-                      turn_order.remove(id)
 
-              send_to_others(tiles.MessagePlayerTurn(turn_order[turn_index]).pack(), con)
-              signal.alarm(timeout)
+# lets through at most `per_second` records each second
+class RateLimit(logging.Filter):
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self.second = None
+        self.count = 0
+        self.suppressed = 0
 
-              # check to see if client eliminated should cause game to finish
-              if check_game_over(con):
-                  break
+    def filter(self, record):
+        second = int(record.created)
 
-        # start next turn, increment the turn index and send next turn to all clients
-        if idnum in turn_order:
-            with lock:
-                turn_order.remove(idnum)
-                turn_order.append(idnum)
+        if second != self.second:
+            if self.suppressed:
+                record.fields = dict(getattr(record, 'fields', {}), suppressed=self.suppressed)
 
-        send_to_all(tiles.MessagePlayerTurn(turn_order[turn_index]).pack())
-        signal.alarm(timeout)
+            self.second = second
+            self.count = 0
+            self.suppressed = 0
 
+        self.count += 1
+        if self.count > self.per_second:
+            self.suppressed += 1
+            return False
 
+        return True
 
-def token_place(msg, connection, idnum):
-    if not board.have_player_position(msg.idnum):
-      if board.set_player_start_position(msg.idnum, msg.x, msg.y, msg.position):
-        signal.alarm(0)
-        # check for token movement
-        positionupdates, eliminated = board.do_player_movement(players_remaining)
 
-        for msg in positionupdates:
-          send_to_all(msg.pack())
+# (re)start the background writer, in this process. a forked worker has to
+# start its own, the parent's thread isn't copied into it
+def start_logging(level=logging.INFO, format='text'):
+    global log_each_message, log_format, log_listener
 
-          # record up to date position of token
-          token_msg = [msg.idnum, msg.x, msg.y, msg.position]
-          current_tokens.append(token_msg)
+    log_format = format
 
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if format == 'json' else TextFormatter())
 
-        if idnum in eliminated and idnum not in players_eliminated:
-          # let clients know player has been eliminated
-          send_to_all(tiles.MessagePlayerEliminated(idnum).pack())
+    records = queue.SimpleQueue()
+    log.handlers = [logging.handlers.QueueHandler(records)]
+    log.setLevel(level)
+    log.propagate = False
 
-          # remove eliminated client from players remaining, add to players eliminated
-          players_remaining.remove(idnum)
-          players_eliminated.append(idnum)
+    message_log.filters = [RateLimit(log_messages_per_second)]
+    log_each_message = message_log.isEnabledFor(logging.DEBUG)
 
-          if idnum in turn_order:
-              with lock:
-                  turn_order.remove(idnum)
+    log_listener = logging.handlers.QueueListener(records, handler)
+    log_listener.start()
 
 
-          # check if this player being eliminated should cause the game to finish
-          if check_game_over(connection):
-              return
+# write out whatever is still queued and stop the writer. called on the way out
+# rather than left to atexit, which a forked worker never runs
+def stop_logging():
+    global log_listener
 
-        # start next turn, increment the turn index and send next turn to all clients
-        if idnum in turn_order:
-            with lock:
-                #turn_index = (turn_index + 1) % len(turn_order)
-                turn_order.remove(idnum)
-                turn_order.append(idnum)
-        send_to_all(tiles.MessagePlayerTurn(turn_order[turn_index]).pack())
-        signal.alarm(timeout)
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
 
 
+##------------------------------------------------------------##
+# Metrics: served over HTTP on metrics_port (each worker of a sharded server on
+# metrics_port + its index), and logged every metrics_interval seconds. None
+# turns either off
 
+metrics_port = None
+metrics_interval = None
 
+registry = metrics.Registry()
 
-def choose_turn():
-    positions = [
-        [0, 0], [0, 1], [0, 2], [0,3], [0, 4],
-        [1, 0], [1, 1], [1, 2], [1,3], [1, 4],
-        [2, 0], [2, 1], [2, 2], [2,3], [2, 4],
-        [3, 0], [3, 1], [3, 2], [3,3], [3, 4],
-        [4, 0], [4, 1], [4, 2], [4,3], [4, 4]
-    ]
+connections_total = registry.counter('tiles_connections_total', 'clients accepted')
+disconnections_total = registry.counter('tiles_disconnections_total', 'clients that have left')
+slow_clients_total = registry.counter('tiles_slow_clients_total', 'clients cut off for not reading')
+games_started_total = registry.counter('tiles_games_started_total', 'games started')
+games_finished_total = registry.counter('tiles_games_finished_total', 'games finished')
+timeouts_total = registry.counter('tiles_turn_timeouts_total', 'turns the server played for a player')
+bot_timeouts_total = registry.counter('tiles_bot_timeouts_total', 'bot moves replaced by a random one')
+bytes_sent_total = registry.counter('tiles_bytes_sent_total', 'bytes queued to clients')
+broadcast_recipients_total = registry.counter('tiles_broadcast_recipients_total',
+    'messages sent by broadcasts to a game, one per recipient')
 
-    border_positions = [
-        [0, 0], [0, 1], [0, 2], [0,3], [0, 4],
-        [1, 0], [1, 4],
-        [2, 0], [2, 4],
-        [3, 0], [3, 4],
-        [4, 0], [4, 1], [4, 2], [4,3], [4, 4]
-    ]
+messages_received_total = registry.counter_family('tiles_messages_received_total',
+    'messages received from clients', 'type', lambda cls: cls.__name__)
+broadcasts_total = registry.counter_family('tiles_broadcasts_total', 'messages broadcast to a game', 'type',
+    lambda typeint: tiles.MessageType(typeint).name)
 
-    global con
+turn_seconds = registry.histogram('tiles_turn_seconds',
+    "time from a player's turn starting to the server receiving their move")
+connect_seconds = registry.histogram('tiles_connect_seconds', 'time spent registering a new client')
+tile_place_seconds = registry.histogram('tiles_tile_place_seconds', 'time spent handling a placed tile')
+token_place_seconds = registry.histogram('tiles_token_place_seconds', 'time spent handling a placed token')
+broadcast_seconds = registry.histogram('tiles_broadcast_seconds', 'time spent sending a message to a game')
 
-    #get player details
-    for key in players:
-        if players[key].id == turn_order[turn_index]:
-            con = key
-
-
-
-    # get positions already taken
-    i = 0
-    for p in board.tileids:
-        if p is not None:
-            if positions[i] in border_positions:
-                border_positions.remove(positions[i])
-        i += 1
-
-
-    if len(placements) < len(players_remaining):
-        # must place first tile on border
-
-        # get random tile position
-        x, y = random.choice(border_positions)
-        idnum = turn_order[turn_index]
-        tileid = random.choice(players[con].hand)
-        rot = random.randrange(4)
-
-        msg = tiles.MessagePlaceTile(idnum, tileid, rot, x, y)
-        tile_place(msg, con, idnum)
-
-    elif len(current_tokens) < len(players_remaining):
-        # must choose token position
-        # get tile position
-
-        idnum = turn_order[turn_index]
-
-        for p in placements:
-            if p[0] == idnum:
-                x = p[3]
-                y = p[4]
-
-        if x == 0 and y == 0:
-            pos = random.choice([4, 5, 6, 7])
-        elif x == 0 and y == tiles.BOARD_HEIGHT-1:
-            pos = random.choice([6, 7, 0, 1])
-        elif y == tiles.BOARD_HEIGHT-1 and x == tiles.BOARD_WIDTH-1:
-            pos = random.choice([0, 1, 2, 3])
-        elif x == tiles.BOARD_WIDTH-1 and y == 0:
-            pos = random.choice([2, 3, 4, 5])
-        elif x == 0:
-            pos = random.choice([6, 7])
-        elif x == tiles.BOARD_WIDTH-1:
-            pos = random.choice([2, 3])
-        elif y == 0:
-            pos = random.choice([4, 5])
-        elif y == tiles.BOARD_HEIGHT-1:
-            pos = random.choice([0, 1])
-
-        #top right = pos 4
-        #top left = pos 5
-        #right top = 3
-        #right bottom = 2
-        #left top = 6
-        #left bottom = 7
-        #bottom left = 0
-        #bottom right = 1
-
-        msg = tiles.MessageMoveToken(idnum, x, y, pos)
-        token_place(msg, con, idnum)
-    else:
-        #normal tile place
-        # get token position
-        idnum = turn_order[turn_index]
-        x, y, pos = board.get_player_position(idnum)
-        tileid = random.choice(players[con].hand)
-        rot = random.randrange(4)
+registry.gauge('tiles_players', 'clients connected', lambda: len(players))
+registry.gauge('tiles_games', 'games in progress', lambda: len(lobby.rooms))
+registry.gauge('tiles_waiting', 'clients waiting for a game', lambda: len(lobby.waiting))
+registry.gauge('tiles_timers', 'timers in the scheduler, counting cancelled ones not yet dropped',
+    lambda: len(scheduler.heap))
 
-        msg = tiles.MessagePlaceTile(idnum, tileid, rot, x, y)
-        tile_place(msg, con, idnum)
 
+# spans for the phases of each turn, off unless the server is run with --trace
+tracer = tracing.tracer
 
+# where to write the trace, each worker of a sharded server to its own file
+trace_path = None
 
-def timeout_player(signum, frame):
-    print('player took to long making turn, server making turn for them...')
-    signal.alarm(0)
-    # choose player turn
-    choose_turn()
 
-    signal.alarm(timeout)
+def log_metrics():
+    log.info('metrics', extra=fields(**registry.summary()))
+    scheduler.call_later(metrics_interval, log_metrics)
 
 
-signal.signal(signal.SIGALRM, timeout_player)
+##------------------------------------------------------------##
+# Journal:
+#
+# every game's broadcasts, appended to a file as they happen. see journal.py
 
+# where to journal, each worker of a sharded server to its own file
+journal_path = None
 
+# when to fsync the journal, one of journal.FSYNC_POLICIES
+journal_fsync = 'interval'
 
+# seconds between fsyncs with the interval policy
+journal_sync_interval = 1
 
+game_journal = None
 
 
-def client_handler(lock, connection, address):
-  host, port = address
-  name = '{}:{}'.format(host, port)
+# replay the journal left by the last run, closing out the games it was in the
+# middle of, and carry on appending to it
+def open_journal():
+    global game_journal, gameno
 
-  idnum = players[connection].id
+    games, end = journal.recover(journal_path)
+    game_journal = journal.Journal(journal_path, journal_fsync, end)
 
-  buffer = bytearray()
+    # their players went down with the server, which is no different to them
+    # all leaving
+    for game in games.values():
+        if not game.finished():
+            log.warning('game interrupted', extra=fields(game=game.id, players=game.players,
+                remaining=game.remaining(), turns=game.turns))
+            for id in game.remaining():
+                game_journal.record(game.id, tiles.MessagePlayerEliminated(id).pack())
+    game_journal.commit()
 
-  while True:
-    chunk = connection.recv(4096)
-    if not chunk:
-      # handle client disconnection
-      print('client {} disconnected'.format(address))
+    # carry on from the last game id, staying on this process's stride
+    if games:
+        last = max(games)
+        if last >= gameno:
+            gameno += (last - gameno) // playerno_step * playerno_step + playerno_step
 
-      # increment turns if it was that players turn
-      if len(players) > 1:
-          if idnum in turn_order:
-              with lock:
-                  turn_order.remove(idnum)
-                  send_to_others(tiles.MessagePlayerTurn(turn_order[turn_index]).pack(), connection)
-                  signal.alarm(timeout)
+    log.info('journalling', extra=fields(path=journal_path, games=len(games), dropped_bytes=game_journal.dropped,
+        fsync=journal_fsync))
 
-      # run the disconnect client function
-      with lock:
-          disconnect_player(connection, idnum)
+    if journal_fsync == 'interval':
+        scheduler.call_later(journal_sync_interval, sync_journal)
 
-          # let other clients know the client has been eliminated, add to players eliminated
-          if idnum not in players_eliminated:
-              send_to_others(tiles.MessagePlayerEliminated(idnum).pack(), connection)
-              players_eliminated.append(idnum)
 
-      send_to_others(tiles.MessagePlayerLeft(idnum).pack(), connection)
+def sync_journal():
+    game_journal.sync()
+    scheduler.call_later(journal_sync_interval, sync_journal)
 
-      # check if client disconnection should cause came to finish
-      if check_game_over(connection):
-          pass
 
-      return
+# every connected client, keyed by connection
+players = {}
 
-    buffer.extend(chunk)
+playerno = 0
 
-    while True:
-      # handle messages from client
-      msg, consumed = tiles.read_message_from_bytearray(buffer)
-      if not consumed:
-        break
+# how far apart the idnums handed out by this process are. a sharded server's
+# workers start from their own index and step by the number of workers, so no
+# two clients anywhere on the server share an idnum
+playerno_step = 1
+
+# ids for games, for the journal, handed out the same way as idnums
+gameno = 0
+
+# runs every change to the players, the lobby and the games, set once the
+# server starts. see Actor
+actor = None
+
+
+# sends made while a batch is open are only queued, and every connection that
+# was sent to is flushed once the outermost batch closes. one is opened around
+# each event the server handles (a move, a timeout, a join), so everything a
+# turn produces reaches each client in a single write
+class SendBatch():
+    def __init__(self):
+        self.depth = 0
+        self.connections = []
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            # the event is journalled before any client hears about it
+            if game_journal is not None:
+                game_journal.commit()
+
+            connections, self.connections = self.connections, []
+            for connection in connections:
+                connection.end_batch()
+
+
+# only ever used by the actor's thread
+batch = SendBatch()
+
+
+# a client's socket and the bytes waiting to be sent to it. send() never
+# blocks: whatever the socket won't take straight away is queued, and the
+# writer is asked to flush it once the socket is writable again. the writer
+# also owns closing the socket
+class Connection():
+    def __init__(self, sock, writer):
+        self.sock = sock
+        self.writer = writer
+        self.outbound = bytearray()
+        self.limit = spectator_backlog
+        self.closed = False
+        self.send_lock = threading.Lock()
+
+        # set while the writer has been asked to flush the queue
+        self.writing = False
+
+        # set while output is being held back by the open batch
+        self.batched = False
+
+    # lets the connection be registered with a selector
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        with self.send_lock:
+            if self.closed:
+                return
+
+            # keep the order, everything goes behind what is already queued
+            self.outbound += data
+            bytes_sent_total.value += len(data)
+
+            if batch.depth:
+                if not self.batched:
+                    self.batched = True
+                    batch.connections.append(self)
+            elif not self.writing:
+                self.send_queued()
+
+            # slow consumer, stop queueing for it and let the reader see the
+            # connection close so it goes through the normal disconnect
+            if len(self.outbound) > self.limit:
+                log.warning('slow client disconnected', extra=fields(fd=self.sock.fileno(),
+                    queued=len(self.outbound)))
+                slow_clients_total.inc()
+                self.abort()
+
+    def end_batch(self):
+        with self.send_lock:
+            self.batched = False
+            if not self.closed and not self.writing and self.outbound:
+                self.send_queued()
+
+    # try to send the whole queue straight away, handing whatever is left over
+    # to the writer. send_lock must be held
+    def send_queued(self):
+        try:
+            sent = self.sock.send(self.outbound, SEND_FLAGS)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.abort()
+            return
+
+        del self.outbound[:sent]
+
+        if self.outbound:
+            self.writing = True
+            self.writer.want_write(self)
+
+    # called by the writer once the socket is writable, sends as much of the
+    # queue as the socket will take. returns True once there is nothing left
+    def flush(self):
+        with self.send_lock:
+            if not self.closed:
+                try:
+                    sent = self.sock.send(self.outbound, SEND_FLAGS)
+                except BlockingIOError:
+                    return False
+                except OSError:
+                    self.abort()
+                else:
+                    del self.outbound[:sent]
+                    if self.outbound:
+                        return False
+
+            self.writing = False
+            return True
+
+    def abort(self):
+        self.closed = True
+        self.outbound.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.send_lock:
+            self.closed = True
+            self.outbound.clear()
+
+        self.writer.close_connection(self)
+
+
+# a callback waiting in the scheduler. ordered by deadline, then by the order
+# they were scheduled in
+class ScheduledCall():
+    __slots__ = ('deadline', 'sequence', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, sequence, callback, args):
+        self.deadline = deadline
+        self.sequence = sequence
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+
+# every pending timer on the server (turn timeouts and game countdowns) in one
+# heap, so arming a timer is O(log n) however many games are running. cancelled
+# calls are left in the heap and skipped when they come up, and the heap is
+# rebuilt if they ever make up most of it. only ever used by the actor's
+# thread, which calls run_due() once next_timeout() has passed
+class Scheduler():
+    def __init__(self):
+        self.heap = []
+        self.sequence = 0
+        self.cancelled = 0
+
+    def call_later(self, delay, callback, *args):
+        self.sequence += 1
+        call = ScheduledCall(time.monotonic() + delay, self.sequence, callback, args)
+        heapq.heappush(self.heap, call)
+        return call
+
+    def cancel(self, call):
+        if call.cancelled:
+            return
+
+        call.cancelled = True
+        self.cancelled += 1
+
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+            self.heap = [call for call in self.heap if not call.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    # seconds until the next call is due, or None if nothing is scheduled
+    def next_timeout(self):
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+
+        if not self.heap:
+            return None
+
+        return max(0, self.heap[0].deadline - time.monotonic())
+
+    # run every call whose deadline has passed
+    def run_due(self):
+        now = time.monotonic()
+
+        while self.heap and self.heap[0].deadline <= now:
+            call = heapq.heappop(self.heap)
+
+            if call.cancelled:
+                self.cancelled -= 1
+                continue
+
+            # stop it being cancelled once it has already run
+            call.cancelled = True
+
+            try:
+                call.callback(*call.args)
+            except Exception:
+                log.exception('scheduled call failed', extra=fields(callback=call.callback.__qualname__))
 
-      buffer = buffer[consumed:]
 
-      print('received message {}, from id: '.format(msg), idnum)
+scheduler = Scheduler()
 
-      # sent by the player to put a tile onto the board (in all turns except
-      # their second)
-      if isinstance(msg, tiles.MessagePlaceTile) and in_progress and idnum == turn_order[turn_index]:
-        tile_place(msg, connection, idnum)
 
-      # sent by the player in the second turn, to choose their token's
-      # starting path
-      elif isinstance(msg, tiles.MessageMoveToken) and in_progress and idnum == turn_order[turn_index]:
-        token_place(msg, connection, idnum)
+# class to consolidate a clients id and address
+class Player():
+    def __init__(self, address, id, hand):
+        self.address = address
+        self.id = id
+        self.hand = hand
 
+        # the room this client is playing in or spectating, if any
+        self.room = None
 
+        # whether the client has a board from an earlier game to clear
+        self.seen_game = False
 
-# create a TCP/IP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-# listen on all network interfaces
-server_address = ('', 30020)
-sock.bind(server_address)
+# where a player is in their game: placing their first tile (on the edge of
+# the board), choosing where their token starts on it, then placing tiles under
+# their token for the rest of the game
+class Phase(enum.Enum):
+    FIRST_TILE = 1
+    CHOOSE_TOKEN = 2
+    PLAYING = 3
+
+
+# a single game, with its own board, turn order and turn timer. the room's
+# connections are its players plus any spectators watching it
+class GameRoom():
+    def __init__(self, lobby, connections):
+        self.lobby = lobby
+        self.connections = list(connections)
+        self.spectators = []
+
+        self.board = tiles.Board()
+        self.in_progress = False
+
+        # the game's id in the journal, given out when it starts
+        self.id = None
 
-sock.setblocking(True)
+        # the player whose turn it is is always turn_order[turn_index], the
+        # order is rotated as turns are taken
+        self.turn_index = 0
+        self.turn_order = []
+
+        # idnum -> Phase, for the players in this game. where their token is
+        # now is kept by the board
+        self.phases = {}
+
+        self.players_remaining = []
+        self.players_eliminated = []
+
+        # idnum -> connection, for the players in this game
+        self.player_connections = {}
+
+        # the room's pending turn timeout or countdown tick, in the scheduler
+        self.timer = None
 
-print('listening on {}'.format(sock.getsockname()))
+        # the bot's move for the current player, while it is being worked out
+        self.bot_future = None
 
-sock.listen(5)
+        # the packed state of the game sent to new spectators, built when it
+        # is first needed after a change
+        self.snapshot_bytes = None
+
+        # tiles and tokens placed since the game started, and when it did
+        self.moves = 0
+        self.start_time = None
 
+        # when the current player's turn started
+        self.turn_started = None
 
+    # send a message to everyone playing or spectating this game. every change
+    # to the game is announced through here, so it also invalidates the
+    # snapshot
+    def send_to_all(self, msg):
+        start = time.perf_counter()
+        self.snapshot_bytes = None
 
+        if game_journal is not None and self.id is not None:
+            game_journal.record(self.id, msg)
 
+        with tracer.span('send_to_all', recipients=len(self.connections)):
+            for key in self.connections:
+                key.send(msg)
 
-# class to consolidate a clients id and address
-class Player():
-    def __init__(self, address, id, hand):
-        self.address = address
-        self.id = id
-        self.hand = hand
+        broadcasts_total.inc(tiles.HEADER_STRUCT.unpack_from(msg)[0])
+        broadcast_recipients_total.value += len(self.connections)
+        broadcast_seconds.observe(time.perf_counter() - start)
+
+    # send a message to everyone in this game except specified client
+    def send_to_others(self, msg, current_con):
+        for key in self.connections:
+            if key is not current_con:
+                key.send(msg)
+
+    def current_player(self):
+        return self.turn_order[self.turn_index]
+
+    # (re)start the turn timer for the current player
+    def set_timer(self):
+        self.cancel_timer()
+        self.timer = scheduler.call_later(timeout, self.timeout_player)
+        self.turn_started = time.monotonic()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            scheduler.cancel(self.timer)
+            self.timer = None
+
+        # the turn has moved on, so any move the bot comes up with is stale
+        if self.bot_future is not None:
+            self.bot_future.cancel()
+            self.bot_future = None
+
+    # handle starting a new game
+    def start(self):
+        # choose turn order for the players in this room
+        order = list(self.connections)
+        random.shuffle(order)
+
+        for key in order:
+            id = players[key].id
+            self.turn_order.append(id)
+            self.players_remaining.append(id)
+            self.player_connections[id] = key
+            self.phases[id] = Phase.FIRST_TILE
+
+            key.limit = player_backlog
+
+            #clear all players' previous hands
+            players[key].hand.clear()
+            players[key].room = self
+            players[key].seen_game = True
+
+        # countdown until start, without holding anything else up
+        self.countdown_tick(countdown)
+
+    # print the seconds left before the game starts, and start it once there
+    # are none
+    def countdown_tick(self, remaining):
+        global gameno
+
+        if remaining > 0:
+            log.info('countdown', extra=fields(players=self.turn_order, remaining=remaining))
+            self.timer = scheduler.call_later(1, self.countdown_tick, remaining - 1)
+            return
+
+        self.timer = None
+        self.in_progress = True
+        self.start_time = time.monotonic()
+        games_started_total.inc()
+
+        self.id = gameno
+        gameno += playerno_step
+
+        log.info('game started', extra=fields(game=self.id, players=self.turn_order))
+
+        ##------------------------------------------------------------##
+        # Client communication:
+
+        # let the players know that the game is starting. anyone who started
+        # spectating during the countdown was welcomed then, and only watches
+        for id in self.turn_order:
+            key = self.player_connections[id]
+            key.send(tiles.MessageWelcome(id).pack())
+
+        self.send_to_all(tiles.MessageGameStart().pack())
+
+        # let clients know of turn order
+        for id in self.turn_order:
+            self.send_to_all(tiles.MessagePlayerTurn(id).pack())
+
+        # send hand to each player
+        for id in self.turn_order:
+            key = self.player_connections[id]
+            # client chooses tiles randomly
+            for _ in range(tiles.HAND_SIZE):
+                tileid = tiles.get_random_tileid()
+                players[key].hand.append(tileid)
+                key.send(tiles.MessageAddTileToHand(tileid).pack())
+
+        # let clients know of actual current turn, last so that it is the turn
+        # clients are left with
+        self.send_to_all(tiles.MessagePlayerTurn(self.current_player()).pack())
+
+        ##------------------------------------------------------------##
+
+        self.set_timer()
+
+    # let a client watch this game, bringing it up to date with the current
+    # state of the game
+    def add_spectator(self, connection):
+        self.connections.append(connection)
+        self.spectators.append(connection)
+
+        connection.send(tiles.MessageWelcome(players[connection].id).pack())
+
+        # a client that was in another game needs its board cleared first
+        if players[connection].seen_game:
+            connection.send(tiles.MessageGameStart().pack())
+
+        players[connection].room = self
+        players[connection].seen_game = True
+
+        connection.send(self.snapshot())
 
+    # the current state of the game as a single buffer: every tile on the board,
+    # where each token is now, who has been eliminated, the turn order, and
+    # whose turn it is. its size depends on the board, not on how long the game
+    # has been going
+    def snapshot(self):
+        if self.snapshot_bytes is None:
+            msgs = []
 
+            for x in range(tiles.BOARD_WIDTH):
+                for y in range(tiles.BOARD_HEIGHT):
+                    tileid, rotation, placer = self.board.get_tile(x, y)
+                    if tileid is not None:
+                        msgs.append(tiles.MessagePlaceTile(placer, tileid, rotation, x, y))
 
+            for idnum in self.board.playerpositions:
+                x, y, position = self.board.get_player_position(idnum)
+                msgs.append(tiles.MessageMoveToken(idnum, x, y, position))
 
-# handle starting a new game
-def start_game():
-    in_progress = True
+            for id in self.players_eliminated:
+                msgs.append(tiles.MessagePlayerEliminated(id))
 
-    global board
-    board.reset()
+            for id in self.turn_order:
+                msgs.append(tiles.MessagePlayerTurn(id))
 
-    global placements
-    global current_tokens
-    global players_remaining
-    global players_eliminated
+            msgs.append(tiles.MessagePlayerTurn(self.current_player()))
 
-    placements.clear()
-    current_tokens.clear()
+            self.snapshot_bytes = bytes(tiles.pack_messages(msgs))
 
+        return self.snapshot_bytes
 
-    # set the turn order and index, stop all threads for spectating for the players joining
+    def remove_spectator(self, connection):
+        self.connections.remove(connection)
+        self.spectators.remove(connection)
+        players[connection].room = None
+
+    # check to see if the game should finish, handing the clients back to the
+    # lobby if so
+    def check_game_over(self):
+        if len(self.players_remaining) <= 1:
+            self.cancel_timer()
+            self.in_progress = False
+            games_finished_total.inc()
+
+            elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+            log.info('game over', extra=fields(winner=self.players_remaining[0] if self.players_remaining else None,
+                moves=self.moves, seconds=round(elapsed, 2),
+                moves_per_second=round(self.moves / elapsed, 2) if elapsed > 0 else 0))
+
+            self.lobby.game_finished(self)
+            return True
+
+        return False
+
+    # remove an eliminated player from the game, returns True if that finished
     # the game
-    total_players = 0
-    available_ids = []
+    def eliminate(self, id):
+        # let all clients know this client has been eliminated
+        self.send_to_all(tiles.MessagePlayerEliminated(id).pack())
 
-    available_ids.clear()
-    players_remaining.clear()
-    players_eliminated.clear()
+        # remove eliminated client from players remaining, add to players eliminated
+        self.players_remaining.remove(id)
+        self.players_eliminated.append(id)
 
-    for key in players:
-        total_players += 1
-        available_ids.append(players[key].id)
+        if id in self.turn_order:
+            self.turn_order.remove(id)
+
+        return self.check_game_over()
+
+    # start next turn, the player who just moved goes to the back of the turn
+    # order
+    def next_turn(self, idnum):
+        with tracer.span('next_turn'):
+            if idnum in self.turn_order:
+                self.turn_order.remove(idnum)
+                self.turn_order.append(idnum)
+
+            self.send_to_all(tiles.MessagePlayerTurn(self.current_player()).pack())
+            self.set_timer()
+
+    # send out token movement and eliminations after a tile or token has been
+    # placed at x, y, returns True if that finished the game
+    def do_movement(self, x, y):
+        # check for token movement, only tokens on the square can have moved
+        with tracer.span('do_player_movement'):
+            positionupdates, eliminated = self.board.do_player_movement_at(x, y, self.players_remaining)
+
+        with tracer.span('send_movement', tokens=len(positionupdates)):
+            for msg in positionupdates:
+                self.send_to_all(msg.pack())
+
+        # check for resulting eliminated players
+        with tracer.span('eliminations', eliminated=len(eliminated)):
+            for id in list(self.players_remaining):
+                if id in eliminated and id not in self.players_eliminated:
+                    # check to see if client eliminated should cause game to finish
+                    if self.eliminate(id):
+                        return True
+
+        return False
+
+    def tile_place(self, msg, con, idnum):
+        # only a tile from their hand, and only when it is their phase to
+        phase = self.phases[idnum]
+        if msg.idnum != idnum or phase is Phase.CHOOSE_TOKEN or msg.tileid not in players[con].hand:
+            return
+
+        with tracer.span('tile_place', idnum=idnum):
+            with tracer.span('set_tile'):
+                placed = self.board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum)
+
+            if placed:
+                self.moves += 1
+                self.send_to_all(msg.pack())
+
+                if phase is Phase.FIRST_TILE:
+                    self.phases[idnum] = Phase.CHOOSE_TOKEN
+
+                # pickup a new tile and remove placed tile from hand
+                players[con].hand.remove(msg.tileid)
+                new_tileid = tiles.get_random_tileid()
+                players[con].hand.append(new_tileid)
+                con.send(tiles.MessageAddTileToHand(new_tileid).pack())
+
+                if self.do_movement(msg.x, msg.y):
+                    return
+
+                self.next_turn(idnum)
+
+    def token_place(self, msg, connection, idnum):
+        if msg.idnum != idnum or self.phases[idnum] is not Phase.CHOOSE_TOKEN:
+            return
+
+        with tracer.span('token_place', idnum=idnum):
+            with tracer.span('set_player_start_position'):
+                placed = self.board.set_player_start_position(msg.idnum, msg.x, msg.y, msg.position)
+
+            if placed:
+                self.phases[idnum] = Phase.PLAYING
+                self.moves += 1
+
+                if self.do_movement(msg.x, msg.y):
+                    return
+
+                self.next_turn(idnum)
+
+    # whether the current player is placing a tile or choosing where their
+    # token starts
+    def turn_phase(self, idnum):
+        if self.phases[idnum] is Phase.CHOOSE_TOKEN:
+            return bots.START_TOKEN
+        return bots.PLACE_TILE
+
+    # make a move for the current player with fallback_bot, which prefers moves
+    # that don't eliminate them
+    def choose_turn(self):
+        idnum = self.current_player()
+        con = self.player_connections[idnum]
+        phase = self.turn_phase(idnum)
+
+        with tracer.span('choose_turn', idnum=idnum):
+            with tracer.span('choose_move'):
+                move = bots.choose_move(fallback_bot, phase, self.board, idnum, players[con].hand,
+                    self.players_remaining)
+
+            self.play_move(phase, move)
+
+    # play a move chosen by a bot for the current player
+    def play_move(self, phase, move):
+        if move is None:
+            return
+
+        idnum = self.current_player()
+        con = self.player_connections[idnum]
+
+        if phase == bots.START_TOKEN:
+            x, y, pos = move
+            self.token_place(tiles.MessageMoveToken(idnum, x, y, pos), con, idnum)
+        else:
+            tileid, rot, x, y = move
+            self.tile_place(tiles.MessagePlaceTile(idnum, tileid, rot, x, y), con, idnum)
 
-        #clear all players' previous hands
-        players[key].hand.clear()
+    # called by the scheduler when the current player runs out of time
+    def timeout_player(self):
+        self.timer = None
+
+        log.info('turn timed out', extra=fields(idnum=self.current_player()))
+        timeouts_total.inc()
+
+        if bot_pool is None:
+            self.auto_move()
+        else:
+            self.ask_bot()
+
+    # make a fallback_bot move, making sure the game can't stall if it was
+    # rejected
+    def auto_move(self):
+        self.choose_turn()
 
-    # choose players for game from player pool
-    for a in range(min(4, total_players)):
-        # get random index
-        index = random.randrange(len(available_ids))
+        if self.in_progress and self.timer is None:
+            self.set_timer()
+
+    # have the bot work out the current player's move in the process pool. if
+    # it hasn't answered by the end of its budget (plus bot_grace) a
+    # fallback_bot move is made instead, so the turn still can't take much
+    # longer than that however busy the pool is
+    def ask_bot(self):
+        idnum = self.current_player()
+        con = self.player_connections[idnum]
+        phase = self.turn_phase(idnum)
+
+        future = bot_pool.submit(bots.choose_move, bot, phase, tiles.CompactBoard.from_board(self.board),
+            idnum, list(players[con].hand), list(self.players_remaining))
+
+        self.bot_future = future
+        self.timer = scheduler.call_later(bot.budget + bot_grace, self.bot_timed_out)
+
+        # the callback runs on one of the pool's threads
+        future.add_done_callback(lambda future: actor.submit(self.bot_answered, future, phase))
+
+    def bot_answered(self, future, phase):
+        # the turn has already moved on
+        if future is not self.bot_future:
+            return
 
-        # get ID from random index and add to turn order
-        id = available_ids.pop(index)
-        turn_order.append(id)
-        players_remaining.append(id)
+        self.cancel_timer()
 
+        try:
+            move = future.result()
+        except Exception:
+            log.exception('bot failed', extra=fields(idnum=self.current_player()))
+            move = None
 
-    # prevent race conditions
-    lock = threading.RLock()
+        self.play_move(phase, move)
 
-    # reset turn index
-    global turn_index
-    turn_index = 0
+        if self.in_progress and self.timer is None:
+            self.auto_move()
 
+    def bot_timed_out(self):
+        self.timer = None
 
-    # countdown until start
-    for x in range(0, countdown):
-        print('starting game in: ', countdown - x)
-        threading.Event().wait(1)
+        log.info('bot timed out', extra=fields(idnum=self.current_player()))
+        bot_timeouts_total.inc()
 
-    print('starting game...')
-    print(turn_order)
+        if self.bot_future is not None:
+            self.bot_future.cancel()
+            self.bot_future = None
 
-    ##------------------------------------------------------------##
-    # Client communication:
+        self.auto_move()
 
-    # let the clients know that the game is starting
+    # handle a client leaving while it was in this game
+    def player_left(self, connection, idnum):
+        self.connections.remove(connection)
+
+        if connection in self.spectators:
+            self.spectators.remove(connection)
+            return
+
+        was_current = self.in_progress and self.current_player() == idnum
+
+        if idnum in self.turn_order:
+            self.turn_order.remove(idnum)
+
+        # let other clients know the client has been eliminated, add to players eliminated
+        if idnum in self.players_remaining:
+            self.players_remaining.remove(idnum)
+            if idnum not in self.players_eliminated:
+                self.send_to_all(tiles.MessagePlayerEliminated(idnum).pack())
+                self.players_eliminated.append(idnum)
+
+        # check if client disconnection should cause game to finish
+        if self.check_game_over():
+            return
+
+        # increment turns if it was that players turn
+        if was_current:
+            self.send_to_all(tiles.MessagePlayerTurn(self.current_player()).pack())
+            self.set_timer()
+
+
+# the pool of clients not currently playing, and the games in progress. waiting
+# clients spectate one of the games until there are enough of them to start
+# one of their own
+class Lobby():
+    def __init__(self, max_rooms=None):
+        self.max_rooms = max_rooms
+        self.waiting = []
+        self.rooms = []
+
+    # keep starting new games while enough players are waiting
+    def start_game(self):
+        while len(self.waiting) >= 2 and (self.max_rooms is None or len(self.rooms) < self.max_rooms):
+            # choose players for game from player pool
+            chosen = random.sample(self.waiting, min(tiles.PLAYER_LIMIT, len(self.waiting)))
+
+            for key in chosen:
+                self.waiting.remove(key)
+
+                # stop spectating, they have a game of their own now
+                if players[key].room is not None:
+                    players[key].room.remove_spectator(key)
+
+            room = GameRoom(self, chosen)
+            self.rooms.append(room)
+            room.start()
+
+        # anyone left over watches a game in progress
+        if self.rooms:
+            for key in self.waiting:
+                if players[key].room is None:
+                    self.rooms[-1].add_spectator(key)
+
+    def game_finished(self, room):
+        self.rooms.remove(room)
+
+        for key in room.connections:
+            key.limit = spectator_backlog
+            players[key].room = None
+            if key not in self.waiting:
+                self.waiting.append(key)
+
+        self.start_game()
+
+
+lobby = Lobby()
+
+
+# send a message to all clients connected to the server
+def send_to_all(msg):
     for key in players:
-        key.send(tiles.MessageWelcome(players[key].id).pack())
+        key.send(msg)
+
+# send a message to all clients except specified client
+def send_to_others(msg, current_con):
+    for key in players:
+        if key is not current_con:
+            key.send(msg)
+
+
+# handle a single message received from a client
+def handle_message(msg, connection):
+    player = players.get(connection)
+    if player is None:
+        return
+
+    idnum = player.id
+    if log_each_message:
+        message_log.debug('message', extra=fields(idnum=idnum, type=type(msg).__name__, body=vars(msg)))
+
+    messages_received_total.inc(type(msg))
+
+    room = player.room
+    if room is None or not room.in_progress or idnum != room.current_player():
+        return
 
-    send_to_all(tiles.MessageGameStart().pack())
+    start = time.perf_counter()
+    turn_started = room.turn_started
+    moves = room.moves
 
-    # let clients know of turn order
-    for id in turn_order:
-        send_to_all(tiles.MessagePlayerTurn(id).pack())
+    # sent by the player to put a tile onto the board (in all turns except
+    # their second)
+    if isinstance(msg, tiles.MessagePlaceTile):
+        room.tile_place(msg, connection, idnum)
+        tile_place_seconds.observe(time.perf_counter() - start)
 
-    # let clients know of actual current turn
-    send_to_all(tiles.MessagePlayerTurn(turn_order[turn_index]).pack())
+    # sent by the player in the second turn, to choose their token's
+    # starting path
+    elif isinstance(msg, tiles.MessageMoveToken):
+        room.token_place(msg, connection, idnum)
+        token_place_seconds.observe(time.perf_counter() - start)
 
-    # send hand to each client
+    # only moves the game accepted count as the end of the player's turn
+    if room.moves != moves and turn_started is not None:
+        turn_seconds.observe(time.monotonic() - turn_started)
+
+
+# handle a client closing its connection
+def handle_disconnect(connection):
+    player = players.pop(connection, None)
+    if player is None:
+        return
+
+    log.info('client disconnected', extra=fields(idnum=player.id, address='{}:{}'.format(*player.address)))
+    disconnections_total.inc()
+
+    if connection in lobby.waiting:
+        lobby.waiting.remove(connection)
+
+    if player.room is not None:
+        player.room.player_left(connection, player.id)
+
+    send_to_all(tiles.MessagePlayerLeft(player.id).pack())
+
+
+# register a newly accepted client, let it know of the other players, and put
+# it in the lobby
+def handle_connect(connection, client_address):
+    global playerno
+
+    start = time.perf_counter()
+    connections_total.inc()
+
+    players[connection] = Player(client_address, playerno, [])
+
+    playerno += playerno_step
+
+    log.info('client connected', extra=fields(idnum=players[connection].id,
+        address='{}:{}'.format(*client_address)))
+
+    # let the client know of the other players on the server
     for key in players:
-        if players[key].id in players_remaining:
-            # client chooses tiles randomly
-            for _ in range(tiles.HAND_SIZE):
-              tileid = tiles.get_random_tileid()
-              players[key].hand.append(tileid)
-              key.send(tiles.MessageAddTileToHand(tileid).pack())
+        if key is not connection:
+            other_host, other_port = players[key].address
+            other_name = '{}:{}'.format(other_host, other_port)
+            connection.send(tiles.MessagePlayerJoined(other_name, players[key].id).pack())
 
-    ##------------------------------------------------------------##
+    # let the existing clients know of this client joining the server
+    host, port = client_address
+    name = '{}:{}'.format(host, port)
+    send_to_others(tiles.MessagePlayerJoined(name, players[connection].id).pack(), connection)
 
+    # start a game if enough players are waiting, otherwise spectate
+    lobby.waiting.append(connection)
+    lobby.start_game()
 
+    connect_seconds.observe(time.perf_counter() - start)
 
 
-# constantly listen for any new connections
-in_progress = False
-while True:
-  # handle each new connection independently
-  connection, client_address = sock.accept()
-  players[connection] = Player(client_address, playerno, [])
+# run one command on the actor's thread, with everything it sends going out
+# together once it is done
+def run_command(command, args):
+    with batch:
+        try:
+            command(*args)
+        except Exception:
+            # a bad command must not take down the thread running every game
+            log.exception('command failed', extra=fields(command=command.__qualname__))
 
-  lock = threading.RLock()
 
+# owns the game state for the threaded server: the players, the lobby and every
+# game are only ever touched from the actor's thread, which runs the commands
+# the client and accept threads submit (messages, connects and disconnects) one
+# at a time, in the order they arrive, along with the scheduler's timeouts and
+# countdowns. the other threads only ever block on their own sockets and the
+# queue, never on each other
+class Actor():
+    def __init__(self):
+        self.commands = queue.SimpleQueue()
 
-  # start thread for the client to spectate
-  threading.Thread(target=client_handler, args=(lock, connection, client_address), daemon=True).start()
+        threading.Thread(target=self.run, daemon=True).start()
 
-  playerno += 1
+    # called from any thread, the command runs on the actor's thread
+    def submit(self, command, *args):
+        self.commands.put((command, args))
 
-  print('received connection from {}'.format(client_address))
+    def run(self):
+        while True:
+            try:
+                command, args = self.commands.get(timeout=scheduler.next_timeout())
+            except queue.Empty:
+                pass
+            else:
+                run_command(command, args)
 
-  # let the client know of the other players on the server
-  for key in players:
-      if key is not connection:
-          other_host, other_port = players[key].address
-          other_name = '{}:{}'.format(other_host, other_port)
-          connection.send(tiles.MessagePlayerJoined(other_name, players[key].id).pack())
+            with batch:
+                scheduler.run_due()
 
-  # let the existing clients know of this client joining the server
-  host, port = client_address
-  name = '{}:{}'.format(host, port)
-  send_to_others(tiles.MessagePlayerJoined(name, players[connection].id).pack(), connection)
+            report_lobby()
 
 
-  # let the client know of the current state of the game if a game is in progress
-  if in_progress:
-      for t in range(len(placements)):
-          place = tiles.MessagePlaceTile(placements[t][0], placements[t][1], placements[t][2], placements[t][3], placements[t][4])
-          connection.send(place.pack())
+def client_handler(connection):
+    reader = tiles.MessageReader(recv_buffer_size)
 
-      for a in range(len(current_tokens)):
-          tok = tiles.MessageMoveToken(current_tokens[a][0], current_tokens[a][1],current_tokens[a][2],current_tokens[a][3])
-          connection.send(tok.pack())
+    while True:
+        try:
+            received = reader.recv(connection.sock)
+        except OSError:
+            received = 0
+
+        if not received:
+            # handle client disconnection
+            connection.close()
+            actor.submit(handle_disconnect, connection)
+            return
+
+        # handle messages from client
+        for msg in reader.read_messages():
+            actor.submit(handle_message, msg, connection)
+
+
+# flushes queued output for the threaded server, so no game code ever waits on
+# a client's socket. it is also the only thread that closes sockets, so a
+# socket can never be closed while it is still registered here
+class WriterThread():
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.pending = []
+        self.closing = []
+        self.pending_lock = threading.Lock()
+
+        # wakes the selector up when there are connections to add or close
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def want_write(self, connection):
+        with self.pending_lock:
+            self.pending.append(connection)
+        self.wakeup()
+
+    def close_connection(self, connection):
+        with self.pending_lock:
+            self.closing.append(connection)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # a wakeup is already waiting to be read
+            pass
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup_recv:
+                    self.handle_pending()
+                elif key.fileobj.flush():
+                    self.selector.unregister(key.fileobj)
+
+    def handle_pending(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+            closing, self.closing = self.closing, []
+
+        registered = self.selector.get_map()
+
+        for connection in pending:
+            if connection.fileno() not in registered:
+                self.selector.register(connection, selectors.EVENT_WRITE)
+
+        for connection in closing:
+            if connection.fileno() in registered:
+                self.selector.unregister(connection)
+            connection.sock.close()
+
+
+# one thread per connection, each blocking in recv() and handing what it reads
+# to the actor. sock is the listening socket, or a HandoffListener in a worker
+# of a sharded server
+def serve_threads(sock):
+    global actor
+
+    sock.setblocking(True)
+
+    writer = WriterThread()
+    actor = Actor()
+
+    # constantly listen for any new connections
+    while True:
+        # handle each new connection independently
+        client, client_address = sock.accept()
+        connection = Connection(client, writer)
+
+        # queued before the client's thread can submit anything for it
+        actor.submit(handle_connect, connection, client_address)
+
+        # start thread for the client to spectate
+        threading.Thread(target=client_handler, args=(connection,), daemon=True).start()
+
+
+# a single selector loop multiplexing every connection, so an idle spectator
+# costs a socket and a small buffer instead of a thread. the loop is the actor
+# here, handling what it reads straight away and taking commands from other
+# threads through submit()
+class EventLoop():
+    def __init__(self, sock):
+        self.sock = sock
+        self.selector = selectors.DefaultSelector()
+
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ)
+
+        # commands from other threads (the bot pool's), which wake the loop
+        # up to run them
+        self.commands = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
+    def submit(self, command, *args):
+        self.commands.put((command, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # a wakeup is already waiting to be read
+            pass
+
+    # called by a connection with output left over, it is flushed once the
+    # selector reports the socket writable
+    def want_write(self, connection):
+        key = self.selector.get_key(connection)
+        self.selector.modify(connection, selectors.EVENT_READ | selectors.EVENT_WRITE, key.data)
+
+    def close_connection(self, connection):
+        self.selector.unregister(connection)
+        connection.sock.close()
+
+    # accept every connection waiting in the backlog
+    def accept_connections(self):
+        while True:
+            try:
+                client, client_address = self.sock.accept()
+            except BlockingIOError:
+                return
+
+            client.setblocking(False)
+            connection = Connection(client, self)
+            self.selector.register(connection, selectors.EVENT_READ, tiles.MessageReader(recv_buffer_size))
+
+            run_command(handle_connect, (connection, client_address))
+
+    # read whatever a client has sent and handle every complete message in it
+    def read_connection(self, key):
+        connection = key.fileobj
+        reader = key.data
+        player = players.get(connection)
+
+        try:
+            received = reader.recv(connection.sock)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+
+        if not received or player is None:
+            connection.close()
+            run_command(handle_disconnect, (connection,))
+            return
+
+        for msg in reader.read_messages():
+            run_command(handle_message, (msg, connection))
+
+    def run_commands(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                command, args = self.commands.get_nowait()
+            except queue.Empty:
+                return
+
+            run_command(command, args)
+
+    def write_connection(self, key):
+        connection = key.fileobj
+        if connection.flush():
+            self.selector.modify(connection, selectors.EVENT_READ, key.data)
+
+    def run(self):
+        while True:
+            timeout = scheduler.next_timeout()
+
+            for key, mask in self.selector.select(timeout):
+                try:
+                    if key.fileobj is self.sock:
+                        self.accept_connections()
+                        continue
+
+                    if key.fileobj is self.wakeup_recv:
+                        self.run_commands()
+                        continue
+
+                    if mask & selectors.EVENT_READ:
+                        self.read_connection(key)
+
+                    # the read may have closed and unregistered the connection
+                    if mask & selectors.EVENT_WRITE and key.fileobj.fileno() != -1:
+                        self.write_connection(key)
+                except Exception:
+                    # a misbehaving client must not take down every other connection
+                    log.exception('connection failed')
+
+            with batch:
+                scheduler.run_due()
+
+            report_lobby()
+
+
+##------------------------------------------------------------##
+# Sharding: with --workers N the server runs as a supervisor process that
+# accepts every connection and hands it (as a file descriptor) to one of N
+# worker processes, each running its own lobby and rooms on its own core.
+# workers report how many of their clients are waiting for a game, and the
+# supervisor sends new clients to a worker with someone waiting, so the players
+# that make up a game always end up in the same process
+
+# the worker's end of its channel to the supervisor, if this is a worker
+supervisor = None
+
+# what was last reported to the supervisor
+reported_lobby = None
+
+
+# let the supervisor know how many clients are waiting for a game here (none,
+# as far as new clients are concerned, if no more rooms can be started) and
+# how many are connected. sent only when they change
+def report_lobby():
+    global reported_lobby
+
+    if supervisor is None:
+        return
+
+    can_start = lobby.max_rooms is None or len(lobby.rooms) < lobby.max_rooms
+    status = (len(lobby.waiting) if can_start else 0, len(players))
+
+    if status != reported_lobby:
+        reported_lobby = status
+        supervisor.send('{} {}'.format(*status).encode())
+
+
+# stands in for the listening socket in a worker: accept() takes the next
+# client passed over from the supervisor
+class HandoffListener():
+    def __init__(self, channel):
+        self.channel = channel
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def setblocking(self, flag):
+        self.channel.setblocking(flag)
+
+    def accept(self):
+        try:
+            _, fds, _, _ = socket.recv_fds(self.channel, 16, 1)
+        except ConnectionResetError:
+            fds = []
+
+        # the supervisor has gone, and no more clients are coming
+        if not fds:
+            raise SystemExit('supervisor exited')
+
+        client = socket.socket(fileno=fds[0])
+        return client, client.getpeername()
 
-      for id in players_eliminated:
-          connection.send(tiles.MessagePlayerEliminated(id).pack())
 
-      for id in turn_order:
-          connection.send(tiles.MessagePlayerTurn(id).pack())
+# the supervisor's view of one worker
+class Worker():
+    def __init__(self, process, channel):
+        self.process = process
+        self.channel = channel
+
+        # as last reported by the worker, plus the clients sent since
+        self.waiting = 0
+        self.connected = 0
+
+    def fileno(self):
+        return self.channel.fileno()
 
-      connection.send(tiles.MessagePlayerTurn(turn_order[turn_index]).pack())
+    def hand_off(self, client):
+        socket.send_fds(self.channel, [b'c'], [client.fileno()])
+        self.waiting += 1
+        self.connected += 1
 
 
-  # start the game if enough players are spectating and a game is not in progress
-  if (len(players) >= 2) and not in_progress:
-      in_progress = True
-      turn_order.clear()
-      start_game()
+# accepts every connection for the workers, passing each client on to the
+# worker with the most clients waiting for a game (so they are matched up), or
+# the least loaded worker if nobody is waiting anywhere
+def supervise(sock, workers):
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    for worker in workers:
+        selector.register(worker, selectors.EVENT_READ)
+
+    while workers:
+        for key, _ in selector.select():
+            if key.fileobj is sock:
+                client, client_address = sock.accept()
+                worker = max(workers, key=lambda worker: (worker.waiting, -worker.connected))
+                try:
+                    worker.hand_off(client)
+                except OSError:
+                    log.exception('hand off failed', extra=fields(worker=worker.process.pid))
+                finally:
+                    client.close()
+                continue
+
+            worker = key.fileobj
+            status = worker.channel.recv(64)
+
+            if status:
+                worker.waiting, worker.connected = map(int, status.split())
+                continue
+
+            # the worker has exited, along with every client it had
+            worker.process.join()
+            log.warning('worker exited', extra=fields(worker=worker.process.pid, code=worker.process.exitcode))
+            selector.unregister(worker)
+            workers.remove(worker)
+            worker.channel.close()
+
+
+# start the workers and supervise them. each worker is forked with the server
+# configured as it is now, and serves its clients in the given mode
+def serve_sharded(sock, count, mode):
+    context = multiprocessing.get_context('fork')
+    workers = []
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    # SIGUSR1 is for the workers, which do the tracing. left to its default it
+    # would kill the supervisor and every game with it. the workers start out
+    # ignoring it too, until they have a tracer to toggle
+    if trace_path is not None:
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    for index in range(count):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        # the worker doesn't need the listening socket or any other worker's
+        # channel, and shouldn't keep them open
+        inherited = [sock] + [worker.channel for worker in workers] + [channel]
+
+        process = context.Process(target=run_worker, args=(worker_channel, index, count, mode, inherited))
+        process.start()
+        worker_channel.close()
+
+        workers.append(Worker(process, channel))
+
+    log.info('supervising workers', extra=fields(workers=[worker.process.pid for worker in workers]))
+
+    if trace_path is not None:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: forward_signal(workers, signum))
+
+    # closing the channels is what tells the workers to stop (and finish off
+    # their traces), which they must before multiprocessing will let us exit
+    try:
+        supervise(sock, workers)
+    finally:
+        for worker in workers:
+            worker.channel.close()
+        stop_logging()
+
+
+def forward_signal(workers, signum):
+    for worker in workers:
+        try:
+            os.kill(worker.process.pid, signum)
+        except ProcessLookupError:
+            # exited, and not yet noticed by supervise
+            pass
+
+
+def run_worker(channel, index, count, mode, inherited):
+    global supervisor, playerno, playerno_step, gameno, metrics_port, trace_path, journal_path
+
+    for sock in inherited:
+        sock.close()
+
+    supervisor = channel
+    playerno = index
+    playerno_step = count
+    gameno = index
+
+    start_logging(log.level, log_format)
+    report_lobby()
+
+    if metrics_port is not None:
+        metrics_port += index
+    if trace_path is not None:
+        trace_path = worker_path(trace_path, index)
+    if journal_path is not None:
+        journal_path = worker_path(journal_path, index)
+
+    serve(HandoffListener(channel), mode)
+
+
+# the file a worker writes in place of path, e.g. games-2.journal
+def worker_path(path, index):
+    root, ext = os.path.splitext(path)
+    return '{}-{}{}'.format(root, index, ext)
+
+
+# stop on SIGTERM the same way as on ctrl-c, so the server still goes through
+# the finally blocks that finish off the trace and the journal
+def terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+# SIGUSR1 handler, a signal that comes in before the actor is running (say
+# while the journal is being replayed) has nothing to switch yet
+def toggle_tracing(signum, frame):
+    if actor is not None:
+        actor.submit(tracer.toggle)
+
+
+# serve clients in this process, taking them from sock
+def serve(sock, mode):
+    global actor, bot_pool
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    # spawned rather than forked, the server has threads running by the time
+    # the first worker starts
+    if bot is not None:
+        bot_pool = concurrent.futures.ProcessPoolExecutor(bot_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    if metrics_port is not None:
+        metrics.serve_http(registry, metrics_port)
+        log.info('serving metrics', extra=fields(address='127.0.0.1:{}'.format(metrics_port)))
+    if metrics_interval is not None:
+        scheduler.call_later(metrics_interval, log_metrics)
+
+    # SIGUSR1 pauses and resumes tracing, flushing the trace so far to disk
+    # when pausing. the actor does the switching, it is the one writing
+    if trace_path is not None:
+        tracer.open(trace_path)
+        log.info('tracing', extra=fields(path=trace_path))
+
+        signal.signal(signal.SIGUSR1, toggle_tracing)
+
+    if journal_path is not None:
+        open_journal()
+
+    # finish the trace off on the way out, so it stays valid JSON, and get the
+    # last of the journal to disk
+    try:
+        if mode == 'events':
+            actor = EventLoop(sock)
+            actor.run()
+        else:
+            serve_threads(sock)
+    finally:
+        tracer.close()
+        if game_journal is not None:
+            game_journal.close()
+        stop_logging()
+
+
+def create_listening_socket(port):
+    # create a TCP/IP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # listen on all network interfaces
+    server_address = ('', port)
+    sock.bind(server_address)
+
+    log.info('listening', extra=fields(address='{}:{}'.format(*sock.getsockname())))
+
+    sock.listen(socket.SOMAXCONN)
+
+    return sock
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiles game server.')
+    parser.add_argument('--mode', choices=['threads', 'events'], default='threads',
+        help='threads: one thread per connection, events: every connection on a single selector loop')
+    parser.add_argument('--max-rooms', type=int, default=None,
+        help='maximum number of games to run at once (default: no limit)')
+    parser.add_argument('--countdown', type=int, default=countdown,
+        help='seconds to count down before each game starts (default: %(default)s)')
+    parser.add_argument('--bot', choices=sorted(bots.BOTS), default='random',
+        help='bot that plays for players who run out of time (default: %(default)s)')
+    parser.add_argument('--bot-budget', type=float, default=0.5,
+        help='seconds the rollout bot may spend on a move (default: %(default)s)')
+    parser.add_argument('--bot-workers', type=int, default=None,
+        help='processes to run the rollout bot in (default: one per cpu)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='processes to share the games out between, each on its own core (default: %(default)s)')
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info',
+        help='least severe log lines to write, debug adds a line per message received (default: %(default)s)')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+        help='text: event key=value ..., json: one object per line (default: %(default)s)')
+    parser.add_argument('--log-messages-per-second', type=int, default=log_messages_per_second,
+        help='most per-message log lines to write each second (default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+        help='serve metrics at http://127.0.0.1:PORT/metrics, a sharded server on PORT + worker index')
+    parser.add_argument('--metrics-interval', type=float, default=None,
+        help='log a summary of the metrics every this many seconds')
+    parser.add_argument('--trace', metavar='FILE', default=None,
+        help='write a Chrome trace of every turn to FILE (kill -USR1 pauses and resumes it)')
+    parser.add_argument('--journal', metavar='FILE', default=None,
+        help='append every game to FILE, replaying it first to close out games a crash interrupted')
+    parser.add_argument('--journal-fsync', choices=journal.FSYNC_POLICIES, default=journal_fsync,
+        help='fsync the journal after every event, every {}s, or never (default: %(default)s)'.format(
+            journal_sync_interval))
+    args = parser.parse_args()
+
+    trace_path = args.trace
+    journal_path = args.journal
+    journal_fsync = args.journal_fsync
+    metrics_port = args.metrics_port
+    metrics_interval = args.metrics_interval
+    log_messages_per_second = args.log_messages_per_second
+    start_logging(getattr(logging, args.log_level.upper()), args.log_format)
+
+    lobby.max_rooms = args.max_rooms
+    countdown = args.countdown
+
+    # the random bot is fast enough to run in the server itself
+    if args.bot == 'rollout':
+        bot = bots.RolloutBot(budget=args.bot_budget)
+
+        # a sharded server's workers share out the cores between their pools
+        bot_workers = args.bot_workers
+        if bot_workers is None and args.workers > 1:
+            bot_workers = max(1, (os.cpu_count() or 1) // args.workers)
+
+    sock = create_listening_socket(30020)
+
+    if args.workers > 1:
+        serve_sharded(sock, args.workers, args.mode)
+    else:
+        serve(sock, args.mode)
@@ -0,0 +1,307 @@
+# Vectorised game engine for simulating many games at once, for balancing and
+# bot training. Needs numpy.
+#
+# BoardBatch holds N boards as numpy arrays and applies the tiles.Board rules
+# for set_tile, set_player_start_position and do_player_movement to all of
+# them in one step. Running this file plays random games through both
+# BoardBatch and tiles.Board and checks they agree move for move:
+#
+#   python simulation.py --games 1000 --seed 3002
+#   python simulation.py --games 100000 --no-check
+
+import argparse
+import time
+
+import numpy as np
+
+import tiles
+
+
+SQUARES = tiles.BOARD_WIDTH * tiles.BOARD_HEIGHT
+
+# tiles.TILE_EXITS, indexed [tileid, rotation, entry position]
+TILE_EXITS = np.array(tiles.TILE_EXITS, dtype=np.intp).reshape(len(tiles.ALL_TILES), 4, 8)
+
+# tiles.CELL_NEIGHBOURS split in two, both indexed [square, exit position]: the
+# square moved into (-1 if that would be off the board), and the position on
+# it that is entered at
+NEIGHBOUR_SQUARES = np.array([-1 if neighbour is None else neighbour[0]
+    for neighbour in tiles.CELL_NEIGHBOURS], dtype=np.intp).reshape(SQUARES, 8)
+NEIGHBOUR_POSITIONS = np.array([0 if neighbour is None else neighbour[1]
+    for neighbour in tiles.CELL_NEIGHBOURS], dtype=np.intp).reshape(SQUARES, 8)
+
+
+def start_positions(x, y):
+    positions = []
+    if y == tiles.BOARD_HEIGHT - 1:
+        positions += [0, 1]
+    if x == tiles.BOARD_WIDTH - 1:
+        positions += [2, 3]
+    if y == 0:
+        positions += [4, 5]
+    if x == 0:
+        positions += [6, 7]
+    return positions
+
+
+# START_POSITIONS[square, position] is True if a token can start there, as
+# checked by Board.set_player_start_position. a player's first tile has to go
+# on one of the EDGE_SQUARES
+START_POSITIONS = np.zeros((SQUARES, 8), dtype=bool)
+for _square in range(SQUARES):
+    START_POSITIONS[_square, start_positions(_square % tiles.BOARD_WIDTH, _square // tiles.BOARD_WIDTH)] = True
+del _square
+
+EDGE_SQUARES = START_POSITIONS.any(axis=1)
+
+
+class BoardBatch:
+    """The state of N games, each with up to `players` players. Players are
+    identified by their index in the game, 0..players-1.
+
+    Squares are indexed x + y*BOARD_WIDTH, as in tiles.Board. Per square:
+    tileids (-1 if empty), rotations (mod 4) and placeids (-1 if empty). Per
+    player: token_squares (-1 if their token isn't on the board yet) and
+    token_positions.
+
+    The methods take one move per game as arrays of shape (games,), and an
+    optional `active` mask of the games the move applies to.
+    """
+
+    def __init__(self, games, players=tiles.PLAYER_LIMIT):
+        self.games = games
+        self.players = players
+        self.rows = np.arange(games)
+
+        self.tileids = np.full((games, SQUARES), -1, dtype=np.int16)
+        self.rotations = np.zeros((games, SQUARES), dtype=np.int8)
+        self.placeids = np.full((games, SQUARES), -1, dtype=np.int16)
+
+        self.token_squares = np.full((games, players), -1, dtype=np.int16)
+        self.token_positions = np.zeros((games, players), dtype=np.int8)
+
+    def set_tile(self, x, y, tileid, rotation, idnum, active=None):
+        """Place a tile in each game, as Board.set_tile. Returns a bool array
+        of the games the tile could be placed in.
+        """
+        square = np.asarray(x) + np.asarray(y)*tiles.BOARD_WIDTH
+        token = self.token_squares[self.rows, idnum]
+
+        # on the player's token, or anywhere on the edge for their first tile
+        placed = np.where(token >= 0, token == square, EDGE_SQUARES[square])
+        placed &= self.tileids[self.rows, square] < 0
+        if active is not None:
+            placed &= active
+
+        games = self.rows[placed]
+        square = square[placed]
+        self.tileids[games, square] = np.asarray(tileid)[placed]
+        self.rotations[games, square] = np.asarray(rotation)[placed] % 4
+        self.placeids[games, square] = np.asarray(idnum)[placed]
+
+        return placed
+
+    def set_player_start_position(self, x, y, position, idnum, active=None):
+        """Start each player's token, as Board.set_player_start_position.
+        Returns a bool array of the games the token was placed in.
+        """
+        square = np.asarray(x) + np.asarray(y)*tiles.BOARD_WIDTH
+        position = np.asarray(position)
+
+        started = self.token_squares[self.rows, idnum] < 0
+        started &= self.tileids[self.rows, square] >= 0
+        started &= self.placeids[self.rows, square] == idnum
+        started &= START_POSITIONS[square, position]
+        if active is not None:
+            started &= active
+
+        games = self.rows[started]
+        idnum = np.asarray(idnum)[started]
+        self.token_squares[games, idnum] = square[started]
+        self.token_positions[games, idnum] = position[started]
+
+        return started
+
+    def do_player_movement(self, live):
+        """Move the tokens of the live players (a bool array of shape
+        (games, players)) in every game, as Board.do_player_movement.
+
+        Returns (moved, eliminated), bool arrays of shape (games, players).
+        """
+        moved = np.zeros((self.games, self.players), dtype=bool)
+        eliminated = np.zeros((self.games, self.players), dtype=bool)
+
+        # every live token sitting on a tile, as flat arrays
+        games, players = np.nonzero(live & (self.token_squares >= 0))
+        square = self.token_squares[games, players].astype(np.intp)
+        position = self.token_positions[games, players].astype(np.intp)
+
+        moving = self.tileids[games, square] >= 0
+        games, players = games[moving], players[moving]
+        square, position = square[moving], position[moving]
+        moved[games, players] = True
+
+        # take every token a square further on each pass, dropping those that
+        # come to rest, until none are left
+        while games.size:
+            tileid = self.tileids[games, square]
+            rotation = self.rotations[games, square]
+            exitposition = TILE_EXITS[tileid, rotation, position]
+
+            nextsquare = NEIGHBOUR_SQUARES[square, exitposition]
+            nextposition = NEIGHBOUR_POSITIONS[square, exitposition]
+
+            # off the board, the token stays at the exit on the edge
+            off = nextsquare < 0
+            self.token_squares[games[off], players[off]] = square[off]
+            self.token_positions[games[off], players[off]] = exitposition[off]
+            eliminated[games[off], players[off]] = True
+
+            on = ~off
+            games, players = games[on], players[on]
+            square, position = nextsquare[on], nextposition[on]
+
+            # an empty square, the token stops there
+            empty = self.tileids[games, square] < 0
+            self.token_squares[games[empty], players[empty]] = square[empty]
+            self.token_positions[games[empty], players[empty]] = position[empty]
+
+            going = ~empty
+            games, players = games[going], players[going]
+            square, position = square[going], position[going]
+
+        return moved, eliminated
+
+
+def check_board(batch, game, board):
+    """Raise AssertionError if game number `game` of the batch doesn't match
+    the tiles.Board.
+    """
+    for square in range(SQUARES):
+        x, y = square % tiles.BOARD_WIDTH, square // tiles.BOARD_WIDTH
+
+        tileid = int(batch.tileids[game, square])
+        if tileid < 0:
+            expected = None, None, None
+        else:
+            expected = tileid, int(batch.rotations[game, square]), int(batch.placeids[game, square])
+
+        if board.get_tile(x, y) != expected:
+            raise AssertionError('game {}: tile at {}, {} is {}, not {}'.format(
+                game, x, y, expected, board.get_tile(x, y)))
+
+    for idnum in range(batch.players):
+        square = int(batch.token_squares[game, idnum])
+        if square < 0:
+            expected = None
+        else:
+            expected = (square % tiles.BOARD_WIDTH, square // tiles.BOARD_WIDTH,
+                int(batch.token_positions[game, idnum]))
+
+        actual = board.get_player_position(idnum) if board.have_player_position(idnum) else None
+        if actual != expected:
+            raise AssertionError('game {}: token of player {} is at {}, not {}'.format(
+                game, idnum, expected, actual))
+
+
+def play_random_games(games, players, seed, check=True):
+    """Play `games` random games to the end, all at once. Every player places
+    random tiles and starts their token at a random position. If check is set,
+    every game is also played through a tiles.Board and compared after every
+    move.
+
+    Returns (batch, live, turns).
+    """
+    rng = np.random.default_rng(seed)
+    batch = BoardBatch(games, players)
+    rows = batch.rows
+
+    boards = [tiles.Board() for _ in range(games)] if check else None
+
+    live = np.ones((games, players), dtype=bool)
+    current = np.zeros(games, dtype=np.intp)
+    finished = np.zeros(games, dtype=bool)
+    turns = 0
+
+    while True:
+        token = batch.token_squares[rows, current].astype(np.intp)
+
+        # a random empty edge square for players yet to place a tile
+        free = EDGE_SQUARES & (batch.tileids < 0)
+        scores = np.where(free, rng.random((games, SQUARES)), -1)
+        edge = scores.argmax(axis=1)
+
+        # a game ends with one player left, or if the next player has nowhere
+        # left to put their first tile
+        finished |= live.sum(axis=1) < 2
+        finished |= (token < 0) & ~free.any(axis=1)
+        active = ~finished
+        if not active.any():
+            break
+
+        square = np.where(token >= 0, token, edge)
+        x, y = square % tiles.BOARD_WIDTH, square // tiles.BOARD_WIDTH
+        tileid = rng.integers(len(tiles.ALL_TILES), size=games)
+        rotation = rng.integers(4, size=games)
+
+        placed = batch.set_tile(x, y, tileid, rotation, current, active)
+
+        # a random start position on the player's first tile
+        starting = placed & (token < 0)
+        scores = np.where(START_POSITIONS[square], rng.random((games, 8)), -1)
+        position = scores.argmax(axis=1)
+        batch.set_player_start_position(x, y, position, current, starting)
+
+        moving = live.copy()
+        moved, eliminated = batch.do_player_movement(moving)
+        live &= ~eliminated
+        turns += 1
+
+        if check:
+            for game in np.nonzero(active)[0]:
+                board = boards[game]
+                idnum = int(current[game])
+
+                if board.set_tile(int(x[game]), int(y[game]), int(tileid[game]), int(rotation[game]), idnum) != placed[game]:
+                    raise AssertionError('game {}: set_tile disagrees'.format(game))
+                if starting[game]:
+                    board.set_player_start_position(idnum, int(x[game]), int(y[game]), int(position[game]))
+
+                updates, board_eliminated = board.do_player_movement(list(np.nonzero(moving[game])[0]))
+
+                if sorted(msg.idnum for msg in updates) != list(np.nonzero(moved[game])[0]):
+                    raise AssertionError('game {}: different tokens moved'.format(game))
+                if sorted(board_eliminated) != list(np.nonzero(eliminated[game])[0]):
+                    raise AssertionError('game {}: different players eliminated'.format(game))
+
+                check_board(batch, game, board)
+
+        # the turn passes to the next live player
+        current[active] = (current[active] + 1) % players
+        for _ in range(players):
+            dead = active & ~live[rows, current]
+            current[dead] = (current[dead] + 1) % players
+
+    return batch, live, turns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play random games with the vectorised engine.')
+    parser.add_argument('--games', type=int, default=1000,
+        help='number of games to play at once (default: %(default)s)')
+    parser.add_argument('--players', type=int, default=tiles.PLAYER_LIMIT,
+        help='players in each game (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=3002,
+        help='seed for the random moves (default: %(default)s)')
+    parser.add_argument('--no-check', dest='check', action='store_false',
+        help="don't check every move against tiles.Board")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    batch, live, turns = play_random_games(args.games, args.players, args.seed, args.check)
+    elapsed = time.perf_counter() - start
+
+    winners = np.bincount(live.sum(axis=1), minlength=2)
+    print('played {} games (the longest took {} turns) in {:.2f}s{}'.format(args.games, turns, elapsed,
+        ', all matched tiles.Board' if args.check else ''))
+    print('games with a single winner: {}, with none: {}'.format(winners[1], winners[0]))
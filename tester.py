@@ -16,15 +16,6 @@ TURN_THINKING_TIME = 0.2
 STATE_MISMATCH_TIME = 0.4
 
 
-if len(sys.argv) < 2:
-  print('usage:\n{} [commands to run server]'.format(sys.argv[0]))
-  exit(1)
-
-print('running server with:\n{}'.format(sys.argv[1:]))
-# pargs = [sys.executable, 'D:\\Networks\\2021\\AssignmentTest\\server-test.py']
-pargs = sys.argv[1:]
-
-
 class EvServerTerminated:
   def __str__(self):
     return "server process terminated"
@@ -115,6 +106,36 @@ def square_is_empty(board: tiles.Board, x: int, y: int):
   return board.tileids[index] == None
 
 
+def choose_turn(board: tiles.Board, idnum: int, hand):
+  """The message for a random move by player idnum, given the board as they
+  see it and the tiles in their hand: a tile on a free edge square for their
+  first turn, then where their token starts on it, then a tile under their
+  token.
+  """
+  if not board.have_player_position(idnum):
+    tilepos = get_player_start_tile(board, idnum)
+    if tilepos != None:
+      x, y = tilepos
+      position = pick_random_start_position(board, x, y)
+      return tiles.MessageMoveToken(idnum, x, y, position)
+    available = []
+    for x in range(board.width):
+      available.append((x, 0))
+      available.append((x, board.height - 1))
+    for y in range(1, board.height - 1):
+      available.append((0, y))
+      available.append((board.width - 1, y))
+    available = [(x, y) for (x, y) in available if square_is_empty(board, x, y)]
+    if not available:
+      raise RuntimeError('border is full but player has not placed starting tile yet')
+    x, y = random.choice(available)
+  else:
+    x, y, _ = board.get_player_position(idnum)
+  tileid = random.choice([tileid for tileid in hand if tileid != None])
+  rotation = random.randrange(0, 4)
+  return tiles.MessagePlaceTile(idnum, tileid, rotation, x, y)
+
+
 def boards_equal(a: tiles.Board, b: tiles.Board):
   for x in range(a.width):
     for y in range(a.height):
@@ -221,7 +242,7 @@ class Client:
     self.message_timer.start()
 
   def reader(self):
-    buffer = bytearray()
+    reader = tiles.MessageReader()
 
     infolock = self.infolock
 
@@ -230,118 +251,111 @@ class Client:
 
     while True:
       try:
-        chunk = self.sock.recv(4096)
-        if chunk:
-          buffer.extend(chunk)
-
-          while True:
-            msg, consumed = tiles.read_message_from_bytearray(buffer)
-            if consumed:
-              buffer = buffer[consumed:]
-
-              self.reset_message_timer()
-
-              if isinstance(msg, tiles.MessageWelcome):
-                with infolock:
-                  self.idnum = msg.idnum
-                  self.playernames[msg.idnum] = 'Me!'
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessagePlayerJoined):
-                with infolock:
-                  self.playernames[msg.idnum] = msg.name
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessagePlayerLeft):
-                with infolock:
-                  if msg.idnum in app.playernames:
-                    del app.playernames[msg.idnum]
-                  else:
-                    raise RuntimeError("didn't know they were a player")
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessageCountdown):
-                pass
-              elif isinstance(msg, tiles.MessageGameStart):
-                self.print('resetting game state')
-                self.reset_game_state()
-                self.putevent(EvReset())
-                self.putevent(EvUpdated())
-                self.print('reset game state')
-              elif isinstance(msg, tiles.MessageAddTileToHand):
-                tileid = msg.tileid
-                if tileid < 0 or tileid > len(tiles.ALL_TILES):
-                  raise RuntimeError('unknown tile index {}'.format(tileid))
-                with infolock:
-                  added = False
-                  for i in range(len(self.hand)):
-                    if self.hand[i] == None:
-                      self.hand[i] = tileid
-                      added = True
-                      break
-                  if not added:
-                    raise RuntimeError('adding tile to hand, but hand is full')
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessagePlayerTurn):
-                with infolock:
-                  if msg.idnum not in self.playernames:
-                    raise RuntimeError('unknown playerid {}'.format(msg.idnum))
-                  playername = self.playernames[msg.idnum]
-                  if not msg.idnum in self.playernums:
-                    playernum = len(self.playernums)
-                    self.playernums[msg.idnum] = playernum
-                    self.playerlist.append(playername)
-                  self.currentplayerid = msg.idnum
-                  if msg.idnum == self.idnum:
-                    self.putevent(EvTurn())
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessagePlaceTile):
-                with infolock:
-                  if msg.idnum not in self.playernames:
-                    raise RuntimeError('unknown playerid {}'.format(msg.idnum))
-                  if msg.x < 0 or msg.x >= tiles.BOARD_WIDTH:
-                    raise RuntimeError('invalid x {}'.format(msg.x))
-                  if msg.y < 0 or msg.y >= tiles.BOARD_HEIGHT:
-                    raise RuntimeError('invalid y {}'.format(msg.y))
-                  idx = self.board.tile_index(msg.x, msg.y)
-                  if self.board.tileids[idx] != None:
-                    raise RuntimeError('placing tile on existing tile!')
-                  self.board.tileids[idx] = msg.tileid
-                  self.board.tilerotations[idx] = msg.rotation
-                  self.board.tileplaceids[idx] = msg.idnum
-                  if msg.idnum == self.idnum:
-                    try:
-                      handidx = self.hand.index(msg.tileid)
-                    except ValueError:
-                      raise RuntimeError('i placed a tile that i do not hold')
-                    self.hand[handidx] = None
-                    self.lasttilelocation = (msg.x, msg.y)
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessageMoveToken):
-                with infolock:
-                  if msg.idnum not in self.playernames:
-                    raise RuntimeError('unknown playerid {}'.format(msg.idnum))
-                  if msg.idnum == self.idnum:
-                    self.location = (msg.x, msg.y, msg.position)
-                  self.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
-                self.putevent(EvUpdated())
-              elif isinstance(msg, tiles.MessagePlayerEliminated):
-                with infolock:
-                  if msg.idnum not in self.playernames:
-                    raise RuntimeError('unknown playerid {}'.format(msg.idnum))
-                  playername = self.playernames[msg.idnum]
-                  if playername not in self.playerlist:
-                    raise RuntimeError('player eliminated, but not in player list')
-                  self.playerlist.remove(playername)
-                  if msg.idnum in self.eliminatedlist:
-                    raise RuntimeError('player eliminated, but already in eliminated list!')
-                  self.eliminatedlist.append(msg.idnum)
-                  if msg.idnum == self.idnum:
-                    self.putevent(EvEliminated())
-                  elif len(self.playerlist) == 1 and self.idnum not in self.eliminatedlist and self.idnum in self.playernums:
-                    self.putevent(EvWon())
-                self.putevent(EvUpdated())
-              else:
-                raise RuntimeError('received unknown message')
+        if reader.recv(self.sock):
+          for msg in reader.read_messages():
+            self.reset_message_timer()
+
+            if isinstance(msg, tiles.MessageWelcome):
+              with infolock:
+                self.idnum = msg.idnum
+                self.playernames[msg.idnum] = 'Me!'
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessagePlayerJoined):
+              with infolock:
+                self.playernames[msg.idnum] = msg.name
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessagePlayerLeft):
+              with infolock:
+                if msg.idnum in app.playernames:
+                  del app.playernames[msg.idnum]
+                else:
+                  raise RuntimeError("didn't know they were a player")
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessageCountdown):
+              pass
+            elif isinstance(msg, tiles.MessageGameStart):
+              self.print('resetting game state')
+              self.reset_game_state()
+              self.putevent(EvReset())
+              self.putevent(EvUpdated())
+              self.print('reset game state')
+            elif isinstance(msg, tiles.MessageAddTileToHand):
+              tileid = msg.tileid
+              if tileid < 0 or tileid > len(tiles.ALL_TILES):
+                raise RuntimeError('unknown tile index {}'.format(tileid))
+              with infolock:
+                if self.idnum not in self.playernums:
+                  raise RuntimeError('dealt a tile, but not playing')
+                added = False
+                for i in range(len(self.hand)):
+                  if self.hand[i] == None:
+                    self.hand[i] = tileid
+                    added = True
+                    break
+                if not added:
+                  raise RuntimeError('adding tile to hand, but hand is full')
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessagePlayerTurn):
+              with infolock:
+                if msg.idnum not in self.playernames:
+                  raise RuntimeError('unknown playerid {}'.format(msg.idnum))
+                playername = self.playernames[msg.idnum]
+                if not msg.idnum in self.playernums:
+                  playernum = len(self.playernums)
+                  self.playernums[msg.idnum] = playernum
+                  self.playerlist.append(playername)
+                self.currentplayerid = msg.idnum
+                if msg.idnum == self.idnum:
+                  self.putevent(EvTurn())
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessagePlaceTile):
+              with infolock:
+                if msg.idnum not in self.playernames:
+                  raise RuntimeError('unknown playerid {}'.format(msg.idnum))
+                if msg.x < 0 or msg.x >= tiles.BOARD_WIDTH:
+                  raise RuntimeError('invalid x {}'.format(msg.x))
+                if msg.y < 0 or msg.y >= tiles.BOARD_HEIGHT:
+                  raise RuntimeError('invalid y {}'.format(msg.y))
+                idx = self.board.tile_index(msg.x, msg.y)
+                if self.board.tileids[idx] != None:
+                  raise RuntimeError('placing tile on existing tile!')
+                self.board.tileids[idx] = msg.tileid
+                self.board.tilerotations[idx] = msg.rotation
+                self.board.tileplaceids[idx] = msg.idnum
+                if msg.idnum == self.idnum:
+                  try:
+                    handidx = self.hand.index(msg.tileid)
+                  except ValueError:
+                    raise RuntimeError('i placed a tile that i do not hold')
+                  self.hand[handidx] = None
+                  self.lasttilelocation = (msg.x, msg.y)
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessageMoveToken):
+              with infolock:
+                if msg.idnum not in self.playernames:
+                  raise RuntimeError('unknown playerid {}'.format(msg.idnum))
+                if msg.idnum == self.idnum:
+                  self.location = (msg.x, msg.y, msg.position)
+                self.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
+              self.putevent(EvUpdated())
+            elif isinstance(msg, tiles.MessagePlayerEliminated):
+              with infolock:
+                if msg.idnum not in self.playernames:
+                  raise RuntimeError('unknown playerid {}'.format(msg.idnum))
+                playername = self.playernames[msg.idnum]
+                if playername not in self.playerlist:
+                  raise RuntimeError('player eliminated, but not in player list')
+                self.playerlist.remove(playername)
+                if msg.idnum in self.eliminatedlist:
+                  raise RuntimeError('player eliminated, but already in eliminated list!')
+                self.eliminatedlist.append(msg.idnum)
+                if msg.idnum == self.idnum:
+                  self.putevent(EvEliminated())
+                elif len(self.playerlist) == 1 and self.idnum not in self.eliminatedlist and self.idnum in self.playernums:
+                  self.putevent(EvWon())
+              self.putevent(EvUpdated())
             else:
-              break
+              raise RuntimeError('received unknown message')
         else:
           print(self.idnum, 'chunk empty')
           break
@@ -352,33 +366,8 @@ class Client:
 
   def take_turn(self):
     with self.infolock:
-      if not self.board.have_player_position(self.idnum):
-        tilepos = get_player_start_tile(self.board, self.idnum)
-        if tilepos != None:
-          x, y = tilepos
-          position = pick_random_start_position(self.board, x, y)
-          msg = tiles.MessageMoveToken(self.idnum, x, y, position)
-          # print('client {} put token at {},{}:{}'.format(self.localid, x, y, position))
-          self.putevent(EvClientMessage(msg))
-          self.sock.sendall(msg.pack())
-          return
-        available = []
-        for x in range(self.board.width):
-          available.append((x, 0))
-          available.append((x, self.board.height - 1))
-        for y in range(1, self.board.height - 1):
-          available.append((0, y))
-          available.append((self.board.width - 1, y))
-        available = [(x, y) for (x, y) in available if square_is_empty(self.board, x, y)]
-        if not available:
-          raise RuntimeError('border is full but player has not placed starting tile yet')
-        x, y = random.choice(available)
-      else:
-        x, y, _ = self.board.get_player_position(self.idnum)
-      tileid = random.choice(self.hand)
-      rotation = random.randrange(0, 4)
-    msg = tiles.MessagePlaceTile(self.idnum, tileid, rotation, x, y)
-    # print('client {} place tile {} at {},{}:{}'.format(self.localid, tileid, x, y, rotation))
+      msg = choose_turn(self.board, self.idnum, self.hand)
+    # print('client {} made move {}'.format(self.localid, msg))
     self.putevent(EvClientMessage(msg))
     self.sock.sendall(msg.pack())
 
@@ -396,8 +385,9 @@ class ProcessEventResult(IntEnum):
 
 
 class Tester:
-  def __init__(self, pargs):
+  def __init__(self, pargs, state_mismatch_time=STATE_MISMATCH_TIME):
     self.pargs = pargs
+    self.state_mismatch_time = state_mismatch_time
 
     self.events = queue.Queue()
     self.server_address = ('localhost', 30020)
@@ -491,9 +481,11 @@ class Tester:
       self.state_mismatch_timer.cancel()
       self.state_mismatch_timer = None
 
-  def set_state_mismatch_timer(self, timeout=STATE_MISMATCH_TIME):
+  def set_state_mismatch_timer(self, timeout=None):
     if self.state_mismatch_timer:
       self.state_mismatch_timer.cancel()
+    if timeout == None:
+      timeout = self.state_mismatch_time
     self.state_mismatch_timer = threading.Timer(timeout, self.complain_state_mismatch)
     self.state_mismatch_timer.start()
 
@@ -632,10 +624,10 @@ class Tester:
       client.close_and_join()
 
 
-def run_a_test(num_initial=2, num_during=0, num_games=1):
+def run_a_test(num_initial=2, num_during=0, num_games=1, server_args=[], state_mismatch_time=STATE_MISMATCH_TIME):
   games_finished = 0
 
-  with Tester(pargs) as tester:
+  with Tester(pargs + server_args, state_mismatch_time) as tester:
     time.sleep(1)
 
     for _ in range(num_initial):
@@ -661,13 +653,25 @@ def run_a_test(num_initial=2, num_during=0, num_games=1):
 
   return 'SUCCESS'
 
-test_results = []
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print('usage:\n{} [commands to run server]'.format(sys.argv[0]))
+    exit(1)
+
+  print('running server with:\n{}'.format(sys.argv[1:]))
+  # pargs = [sys.executable, 'D:\\Networks\\2021\\AssignmentTest\\server-test.py']
+  pargs = sys.argv[1:]
+
+  test_results = []
 
-test_results.append('TWO PLAYERS: {}'.format(run_a_test()))
-test_results.append('TWO PLAYERS x TWO GAMES: {}'.format(run_a_test(num_games=2)))
-test_results.append('FOUR PLAYERS: {}'.format(run_a_test(num_initial=4)))
-test_results.append('FOUR PLAYERS x TWO GAMES: {}'.format(run_a_test(num_initial=4, num_games=2)))
-test_results.append('TWO PLAYERS + TWO NEW, TWO GAMES: {}'.format(run_a_test(num_during=2, num_games=2)))
+  test_results.append('TWO PLAYERS: {}'.format(run_a_test()))
+  test_results.append('TWO PLAYERS x TWO GAMES: {}'.format(run_a_test(num_games=2)))
+  test_results.append('FOUR PLAYERS: {}'.format(run_a_test(num_initial=4)))
+  test_results.append('FOUR PLAYERS x TWO GAMES: {}'.format(run_a_test(num_initial=4, num_games=2)))
+  test_results.append('TWO PLAYERS + TWO NEW, TWO GAMES: {}'.format(run_a_test(num_during=2, num_games=2)))
+  # players only hear they are in a game once the countdown is over, so give
+  # the clients that long to agree
+  test_results.append('THREE CLIENTS, COUNTDOWN: {}'.format(run_a_test(num_initial=3, server_args=['--countdown', '2'], state_mismatch_time=3)))
 
-for result in test_results:
-  print(result)
+  for result in test_results:
+    print(result)
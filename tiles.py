@@ -8,6 +8,7 @@
 # match the below.
 
 import struct
+from array import array
 from enum import IntEnum
 from random import randrange
 
@@ -36,21 +37,39 @@ class MessageType(IntEnum):
   PLAYER_ELIMINATED = 10
 
 
+# precompiled layouts for every message, so that packing and unpacking never
+# re-parses a format string
+HEADER_STRUCT = struct.Struct('!H')
+IDNUM_STRUCT = struct.Struct('!HH')
+PLAYER_JOINED_STRUCT = struct.Struct('!HHH')
+PLACE_TILE_STRUCT = struct.Struct('!HHHHHH')
+MOVE_TOKEN_STRUCT = struct.Struct('!HHHHH')
+
+
 class MessageWelcome():
   """Sent by the server to joining clients, to notify them of their idnum."""
 
+  TYPE = int(MessageType.WELCOME)
+
   def __init__(self, idnum: int):
     self.idnum = idnum
 
   def pack(self):
-    return struct.pack('!HH', MessageType.WELCOME, self.idnum)
+    return IDNUM_STRUCT.pack(self.TYPE, self.idnum)
+
+  def pack_into(self, buffer, offset: int):
+    IDNUM_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum)
+    return offset + IDNUM_STRUCT.size
+
+  def packed_size(self):
+    return IDNUM_STRUCT.size
 
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
 
     return None, 0
@@ -63,23 +82,41 @@ class MessagePlayerJoined():
   This indicates the name and (unique) idnum for the new client.
   """
 
+  TYPE = int(MessageType.PLAYER_JOINED)
+
   def __init__(self, name: str, idnum: int):
     self.name = name
     self.idnum = idnum
 
   def pack(self):
-    return struct.pack('!HHH{}s'.format(len(self.name)),
-      MessageType.PLAYER_JOINED, self.idnum,
-      len(self.name), bytes(self.name, 'utf-8'))
+    namelen = len(self.name)
+    return PLAYER_JOINED_STRUCT.pack(self.TYPE, self.idnum, namelen) + self.packed_name()
 
-  @classmethod
-  def unpack(cls, bs: bytearray):
-    headerlen = struct.calcsize('!HHH')
+  def pack_into(self, buffer, offset: int):
+    namelen = len(self.name)
+    PLAYER_JOINED_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum, namelen)
+    offset += PLAYER_JOINED_STRUCT.size
+    buffer[offset:offset + namelen] = self.packed_name()
+    return offset + namelen
+
+  def packed_name(self):
+    # the length field counts characters, and the name is cut or zero padded
+    # to that many bytes, exactly as the '{}s' format always did
+    namelen = len(self.name)
+    return bytes(self.name, 'utf-8')[:namelen].ljust(namelen, b'\0')
 
-    if len(bs) >= headerlen:
-      _, idnum, namelen = struct.unpack_from('!HHH', bs, 0)
-      if len(bs) >= headerlen + namelen:
-        name, = struct.unpack_from('!{}s'.format(namelen), bs, headerlen)
+  def packed_size(self):
+    return PLAYER_JOINED_STRUCT.size + len(self.name)
+
+  @classmethod
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    headerlen = PLAYER_JOINED_STRUCT.size
+
+    if len(bs) - offset >= headerlen:
+      _, idnum, namelen = PLAYER_JOINED_STRUCT.unpack_from(bs, offset)
+      if len(bs) - offset >= headerlen + namelen:
+        start = offset + headerlen
+        name = bytes(bs[start:start + namelen])
         return MessagePlayerJoined(name, idnum), headerlen + namelen
 
     return None, 0
@@ -90,18 +127,27 @@ class MessagePlayerJoined():
 class MessagePlayerLeft():
   """Sent by the server to all remaining clients, when a client leaves."""
 
+  TYPE = int(MessageType.PLAYER_LEFT)
+
   def __init__(self, idnum: int):
     self.idnum = idnum
 
   def pack(self):
-    return struct.pack('!HH', MessageType.PLAYER_LEFT, self.idnum)
+    return IDNUM_STRUCT.pack(self.TYPE, self.idnum)
+
+  def pack_into(self, buffer, offset: int):
+    IDNUM_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum)
+    return offset + IDNUM_STRUCT.size
+
+  def packed_size(self):
+    return IDNUM_STRUCT.size
 
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
 
     return None, 0
@@ -114,15 +160,43 @@ class MessageCountdown():
   started.
   """
 
+  TYPE = int(MessageType.COUNTDOWN_STARTED)
+  PACKED = HEADER_STRUCT.pack(TYPE)
+
   def pack(self):
-    return struct.pack('!H', MessageType.COUNTDOWN_STARTED)
+    return self.PACKED
+
+  def pack_into(self, buffer, offset: int):
+    HEADER_STRUCT.pack_into(buffer, offset, self.TYPE)
+    return offset + HEADER_STRUCT.size
+
+  def packed_size(self):
+    return HEADER_STRUCT.size
+
+  @classmethod
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    return cls(), HEADER_STRUCT.size
 
 
 class MessageGameStart():
   """Sent by the server to all clients, when a new game has started."""
 
+  TYPE = int(MessageType.GAME_START)
+  PACKED = HEADER_STRUCT.pack(TYPE)
+
   def pack(self):
-    return struct.pack('!H', MessageType.GAME_START)
+    return self.PACKED
+
+  def pack_into(self, buffer, offset: int):
+    HEADER_STRUCT.pack_into(buffer, offset, self.TYPE)
+    return offset + HEADER_STRUCT.size
+
+  def packed_size(self):
+    return HEADER_STRUCT.size
+
+  @classmethod
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    return cls(), HEADER_STRUCT.size
 
 
 class MessageAddTileToHand():
@@ -130,18 +204,27 @@ class MessageAddTileToHand():
   hand.
   """
 
+  TYPE = int(MessageType.ADD_TILE_TO_HAND)
+
   def __init__(self, tileid):
     self.tileid = tileid
 
   def pack(self):
-    return struct.pack('!HH', MessageType.ADD_TILE_TO_HAND, self.tileid)
+    return IDNUM_STRUCT.pack(self.TYPE, self.tileid)
+
+  def pack_into(self, buffer, offset: int):
+    IDNUM_STRUCT.pack_into(buffer, offset, self.TYPE, self.tileid)
+    return offset + IDNUM_STRUCT.size
+
+  def packed_size(self):
+    return IDNUM_STRUCT.size
 
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, tileid = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, tileid = IDNUM_STRUCT.unpack_from(bs, offset)
       return MessageAddTileToHand(tileid), messagelen
 
     return None, 0
@@ -154,18 +237,27 @@ class MessagePlayerTurn():
   started.
   """
 
+  TYPE = int(MessageType.PLAYER_TURN)
+
   def __init__(self, idnum: int):
     self.idnum = idnum
 
   def pack(self):
-    return struct.pack('!HH', MessageType.PLAYER_TURN, self.idnum)
+    return IDNUM_STRUCT.pack(self.TYPE, self.idnum)
+
+  def pack_into(self, buffer, offset: int):
+    IDNUM_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum)
+    return offset + IDNUM_STRUCT.size
+
+  def packed_size(self):
+    return IDNUM_STRUCT.size
 
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
 
     return None, 0
@@ -181,6 +273,8 @@ class MessagePlaceTile():
   the board.
   """
 
+  TYPE = int(MessageType.PLACE_TILE)
+
   def __init__(self, idnum: int, tileid: int, rotation: int, x: int, y: int):
     self.idnum = idnum
     self.tileid = tileid
@@ -189,15 +283,23 @@ class MessagePlaceTile():
     self.y = y
 
   def pack(self):
-    return struct.pack('!HHHHHH', MessageType.PLACE_TILE, self.idnum,
+    return PLACE_TILE_STRUCT.pack(self.TYPE, self.idnum,
       self.tileid, self.rotation, self.x, self.y)
 
+  def pack_into(self, buffer, offset: int):
+    PLACE_TILE_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum,
+      self.tileid, self.rotation, self.x, self.y)
+    return offset + PLACE_TILE_STRUCT.size
+
+  def packed_size(self):
+    return PLACE_TILE_STRUCT.size
+
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HHHHHH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = PLACE_TILE_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum, tileid, rotation, x, y = struct.unpack_from('!HHHHHH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum, tileid, rotation, x, y = PLACE_TILE_STRUCT.unpack_from(bs, offset)
       return MessagePlaceTile(idnum, tileid, rotation, x, y), messagelen
 
     return None, 0
@@ -214,6 +316,8 @@ class MessageMoveToken():
   tile causes their token to move).
   """
 
+  TYPE = int(MessageType.MOVE_TOKEN)
+
   def __init__(self, idnum: int, x: int, y: int, position: int):
     self.idnum = idnum
     self.x = x
@@ -221,15 +325,23 @@ class MessageMoveToken():
     self.position = position
 
   def pack(self):
-    return struct.pack('!HHHHH', MessageType.MOVE_TOKEN, self.idnum,
+    return MOVE_TOKEN_STRUCT.pack(self.TYPE, self.idnum,
       self.x, self.y, self.position)
 
+  def pack_into(self, buffer, offset: int):
+    MOVE_TOKEN_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum,
+      self.x, self.y, self.position)
+    return offset + MOVE_TOKEN_STRUCT.size
+
+  def packed_size(self):
+    return MOVE_TOKEN_STRUCT.size
+
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HHHHH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = MOVE_TOKEN_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum, x, y, position = struct.unpack_from('!HHHHH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum, x, y, position = MOVE_TOKEN_STRUCT.unpack_from(bs, offset)
       return cls(idnum, x, y, position), messagelen
 
     return None, 0
@@ -243,18 +355,27 @@ class MessagePlayerEliminated():
   client disconnected).
   """
 
+  TYPE = int(MessageType.PLAYER_ELIMINATED)
+
   def __init__(self, idnum: int):
     self.idnum = idnum
 
   def pack(self):
-    return struct.pack('!HH', MessageType.PLAYER_ELIMINATED, self.idnum)
+    return IDNUM_STRUCT.pack(self.TYPE, self.idnum)
+
+  def pack_into(self, buffer, offset: int):
+    IDNUM_STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum)
+    return offset + IDNUM_STRUCT.size
+
+  def packed_size(self):
+    return IDNUM_STRUCT.size
 
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
 
     return None, 0
@@ -263,6 +384,23 @@ class MessagePlayerEliminated():
     return "A player has been eliminated!"
 
 
+# message type id -> unpack function for that message
+MESSAGE_UNPACKERS = {
+  cls.TYPE: cls.unpack for cls in [
+    MessageWelcome,
+    MessagePlayerJoined,
+    MessagePlayerLeft,
+    MessageCountdown,
+    MessageGameStart,
+    MessageAddTileToHand,
+    MessagePlayerTurn,
+    MessagePlaceTile,
+    MessageMoveToken,
+    MessagePlayerEliminated,
+  ]
+}
+
+
 def read_message_from_bytearray(bs: bytearray):
   """Attempts to read and unpack a single message from the beginning of the
   provided bytearray. If successful, it returns (msg, number_of_bytes_consumed).
@@ -270,45 +408,126 @@ def read_message_from_bytearray(bs: bytearray):
   (None, 0).
   """
 
-  msg = None
-  consumed = 0
+  if len(bs) >= HEADER_STRUCT.size:
+    typeint, = HEADER_STRUCT.unpack_from(bs, 0)
+
+    unpack = MESSAGE_UNPACKERS.get(typeint)
+    if unpack is not None:
+      return unpack(bs)
+
+  return None, 0
+
+
+def read_messages_from_bytearray(bs: bytearray, offset: int = 0):
+  """Reads and unpacks every complete message in bs, starting at offset.
+  Returns (msgs, new_offset), where new_offset is the start of the first
+  message that couldn't be read (because it is incomplete or of an unknown
+  type), or len(bs) if everything was read.
+  """
+
+  msgs = []
+  end = len(bs)
+  headersize = HEADER_STRUCT.size
+  unpack_header = HEADER_STRUCT.unpack_from
+  unpackers = MESSAGE_UNPACKERS
+
+  while end - offset >= headersize:
+    typeint, = unpack_header(bs, offset)
+
+    unpack = unpackers.get(typeint)
+    if unpack is None:
+      break
+
+    msg, consumed = unpack(bs, offset)
+    if not consumed:
+      break
+
+    msgs.append(msg)
+    offset += consumed
+
+  return msgs, offset
+
+
+def pack_messages(msgs):
+  """Pack a sequence of messages into a single bytearray, writing each one
+  straight into place with pack_into.
+  """
+  buffer = bytearray(sum(msg.packed_size() for msg in msgs))
+
+  offset = 0
+  for msg in msgs:
+    offset = msg.pack_into(buffer, offset)
+
+  return buffer
+
 
-  typesize = struct.calcsize('!H')
+class MessageReader:
+  """Receives from a socket straight into a preallocated buffer (recv_into),
+  and parses messages in place through a memoryview, so that neither receiving
+  nor consuming a message copies the rest of the buffer.
 
-  if len(bs) >= typesize:
-    typeint, = struct.unpack_from('!H', bs, 0)
+  The unparsed bytes are tracked as buffer[start:end]. Once everything received
+  has been parsed both offsets go back to 0; a partial message is only moved to
+  the front when the buffer has no room left at the end.
+  """
+
+  def __init__(self, size: int = 4096):
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.start = 0
+    self.end = 0
+
+  def recv(self, sock):
+    """Receive whatever is available from sock into the buffer. Returns the
+    number of bytes received, which is 0 if the connection has closed.
+    """
+    if self.end == len(self.buffer):
+      self.make_room()
 
-    if typeint == MessageType.WELCOME:
-      msg, consumed = MessageWelcome.unpack(bs)
+    received = sock.recv_into(self.view[self.end:])
+    self.end += received
+    return received
 
-    elif typeint == MessageType.PLAYER_JOINED:
-      msg, consumed = MessagePlayerJoined.unpack(bs)
+  def read_message(self):
+    """Parse and consume the next complete message, or return None if the
+    buffer doesn't hold one yet.
+    """
+    msg, consumed = read_message_from_bytearray(self.view[self.start:self.end])
+    if not consumed:
+      return None
 
-    elif typeint == MessageType.PLAYER_LEFT:
-      msg, consumed = MessagePlayerLeft.unpack(bs)
+    self.start += consumed
+    if self.start == self.end:
+      self.start = 0
+      self.end = 0
 
-    elif typeint == MessageType.COUNTDOWN_STARTED:
-      msg, consumed = MessageCountdown(), typesize
+    return msg
 
-    elif typeint == MessageType.GAME_START:
-      msg, consumed = MessageGameStart(), typesize
+  def read_messages(self):
+    """Parse and consume every complete message in the buffer, returning them
+    as a list (empty if there isn't a complete message yet).
+    """
+    msgs, self.start = read_messages_from_bytearray(self.view[:self.end], self.start)
 
-    elif typeint == MessageType.ADD_TILE_TO_HAND:
-      msg, consumed = MessageAddTileToHand.unpack(bs)
+    if self.start == self.end:
+      self.start = 0
+      self.end = 0
 
-    elif typeint == MessageType.PLAYER_TURN:
-      msg, consumed = MessagePlayerTurn.unpack(bs)
+    return msgs
 
-    elif typeint == MessageType.PLACE_TILE:
-      msg, consumed = MessagePlaceTile.unpack(bs)
+  def make_room(self):
+    remaining = self.end - self.start
 
-    elif typeint == MessageType.MOVE_TOKEN:
-      msg, consumed = MessageMoveToken.unpack(bs)
+    if remaining == len(self.buffer):
+      # a single message bigger than the whole buffer, so grow it
+      self.view.release()
+      self.buffer = self.buffer + bytearray(len(self.buffer))
+      self.view = memoryview(self.buffer)
+    elif remaining:
+      self.buffer[:remaining] = self.view[self.start:self.end]
 
-    elif typeint == MessageType.PLAYER_ELIMINATED:
-      msg, consumed = MessagePlayerEliminated.unpack(bs)
-  #print("MESSAGE@@@@@@@@@", msg, type(msg))
-  return msg, consumed
+    self.start = 0
+    self.end = remaining
 
 
 def get_random_tileid():
@@ -329,6 +548,7 @@ class Board:
     self.tileplaceids = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
     self.tilerects = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
     self.playerpositions = {}
+    self.squaretokens = {}
     self.tile_size_px = 100
 
   def reset(self):
@@ -339,6 +559,7 @@ class Board:
       self.tileplaceids[i] = None
 
     self.playerpositions = {}
+    self.squaretokens = {}
 
   def get_tile(self, x: int, y: int):
     """Get (tile id, rotation, placer id) for location x, y."""
@@ -453,43 +674,100 @@ class Board:
     positionupdates = []
     eliminated = []
 
+    width = self.width
+    tileids = self.tileids
+
     for idnum, playerposition in self.playerpositions.items():
       # don't keep moving expired players around
       if not idnum in live_idnums:
         continue
 
       x, y, position = playerposition
-      idx = self.tile_index(x, y)
-      moved = False
+      idx = x + y*width
 
-      while self.tileids[idx] != None:
-        moved = True
-        tileid = self.tileids[idx]
-        rotation = self.tilerotations[idx]
-        tile = ALL_TILES[tileid]
-        exitposition = tile.getmovement(rotation, position)
+      if tileids[idx] != None:
+        self.move_token(idnum, idx, position, positionupdates, eliminated)
 
-        # determine next square to move into from this exit position
-        dx, dy, dposition = CONNECTION_NEIGHBOURS[exitposition]
-        nx = x + dx
-        ny = y + dy
+    return positionupdates, eliminated
 
-        # if that square would be off the board, we're eliminated
-        if nx < 0 or nx >= BOARD_WIDTH or ny < 0 or ny >= BOARD_HEIGHT:
-          position = exitposition
-          eliminated.append(idnum)
-          break
+  def do_player_movement_at(self, x: int, y: int, live_idnums):
+    """Move the tokens after a tile has been placed at x, y (or a token has
+    been started there), returning the same (positionupdates, eliminated) as
+    do_player_movement.
 
-        # otherwise move into that square and continue the loop (if a tile is in the square)
-        x, y, position = nx, ny, dposition
-        idx = self.tile_index(x, y)
+    Tokens only ever come to rest on empty squares, so the only tokens a
+    placement can move are the ones on that square. Only those are looked at,
+    in the order they arrived on it, so the cost doesn't grow with the number
+    of tokens on the board.
+    """
+    positionupdates = []
+    eliminated = []
+
+    idx = self.tile_index(x, y)
+    if self.tileids[idx] == None:
+      return positionupdates, eliminated
 
-      if moved:
-        self.update_player_position(idnum, x, y, position)
-        positionupdates.append(MessageMoveToken(idnum, x, y, position))
+    # moving a token takes it off this square, so iterate over a copy
+    for idnum in list(self.squaretokens.get(idx, ())):
+      if not idnum in live_idnums:
+        continue
+
+      _, _, position = self.playerpositions[idnum]
+      self.move_token(idnum, idx, position, positionupdates, eliminated)
 
     return positionupdates, eliminated
 
+  def legal_tile_moves(self, idnum, hand):
+    """List every tile placement the given player can make from their hand, as
+    (tileid, rotation, x, y, eliminated) tuples. eliminated is True if the
+    placement would move the player's own token off the edge of the board.
+
+    A player with a token on the board must place on its square, otherwise they
+    can place on any empty edge square (which can't eliminate them, as their
+    token isn't on the board yet).
+    """
+    tileids = dict.fromkeys(hand)
+    moves = []
+
+    if idnum in self.playerpositions:
+      x, y, position = self.playerpositions[idnum]
+      idx = self.tile_index(x, y)
+
+      if self.tileids[idx] == None:
+        for tileid in tileids:
+          for rotation in range(4):
+            _, _, eliminated = self.trace_token(idx, position, (idx, tileid, rotation))
+            moves.append((tileid, rotation, x, y, eliminated))
+    else:
+      for idx, positions in enumerate(EDGE_POSITIONS):
+        if positions and self.tileids[idx] == None:
+          x, y = idx % self.width, idx // self.width
+          for tileid in tileids:
+            for rotation in range(4):
+              moves.append((tileid, rotation, x, y, False))
+
+    return moves
+
+  def legal_start_positions(self, idnum):
+    """List every place the given player can start their token, as
+    (x, y, position, eliminated) tuples: the edge positions of the tiles they
+    have placed. eliminated is True if the token would be moved straight off
+    the edge of the board. Empty if their token is already on the board.
+    """
+    moves = []
+
+    if idnum in self.playerpositions:
+      return moves
+
+    for idx, positions in enumerate(EDGE_POSITIONS):
+      if self.tileplaceids[idx] == idnum and self.tileids[idx] != None:
+        x, y = idx % self.width, idx // self.width
+        for position in positions:
+          _, _, eliminated = self.trace_token(idx, position)
+          moves.append((x, y, position, eliminated))
+
+    return moves
+
   #
   # METHODS BELOW HERE ARE PRIVATE OR ONLY NEEDED BY THE CLIENT
   # -----------------------------------------------------------
@@ -497,9 +775,82 @@ class Board:
   def tile_index(self, x: int, y :int):
     return x + y*self.width
 
+  def move_token(self, idnum, idx: int, position: int, positionupdates, eliminated):
+    """Move a token that is at position on square idx, which has a tile on it,
+    along the tiles until it reaches an empty square or the edge of the board.
+    The update (and the elimination, if it reached the edge) are appended to
+    positionupdates and eliminated.
+    """
+    tileids = self.tileids
+    tilerotations = self.tilerotations
+    tile_exits = TILE_EXITS
+    cell_neighbours = CELL_NEIGHBOURS
+
+    startidx = idx
+    tileid = tileids[idx]
+
+    while tileid != None:
+      # follow the tile's connector, then step into the neighbouring square
+      exitposition = tile_exits[(tileid*4 + tilerotations[idx]%4)*8 + position]
+      neighbour = cell_neighbours[idx*8 + exitposition]
+
+      # if that square would be off the board, we're eliminated
+      if neighbour == None:
+        position = exitposition
+        eliminated.append(idnum)
+        break
+
+      # otherwise move into that square and continue the loop (if a tile is in the square)
+      idx, position = neighbour
+      tileid = tileids[idx]
+
+    # update_player_position inlined, the square the token started on is
+    # already known
+    y, x = divmod(idx, self.width)
+    squaretokens = self.squaretokens
+    del squaretokens[startidx][idnum]
+    self.playerpositions[idnum] = (x, y, position)
+    squaretokens.setdefault(idx, {})[idnum] = None
+
+    positionupdates.append(MessageMoveToken(idnum, x, y, position))
+
+  def trace_token(self, idx: int, position: int, placed=None):
+    """Follow the path of a token at position on square idx without moving it.
+    placed can be a (square, tileid, rotation) to treat as if it had been
+    placed on the board.
+
+    Returns where the token would come to rest as (idx, position, eliminated).
+    """
+    tileids = self.tileids
+    tilerotations = self.tilerotations
+
+    while True:
+      if placed != None and idx == placed[0]:
+        _, tileid, rotation = placed
+      else:
+        tileid = tileids[idx]
+        if tileid == None:
+          return idx, position, False
+        rotation = tilerotations[idx]
+
+      exitposition = TILE_EXITS[(tileid*4 + rotation%4)*8 + position]
+      neighbour = CELL_NEIGHBOURS[idx*8 + exitposition]
+
+      if neighbour == None:
+        return idx, exitposition, True
+
+      idx, position = neighbour
+
   def update_player_position(self, idnum, x: int, y: int, position: int):
+    if idnum in self.playerpositions:
+      oldx, oldy, _ = self.playerpositions[idnum]
+      del self.squaretokens[self.tile_index(oldx, oldy)][idnum]
+
     self.playerpositions[idnum] = (x, y, position)
 
+    # kept as dicts of idnum -> None, as ordered sets
+    self.squaretokens.setdefault(self.tile_index(x, y), {})[idnum] = None
+
   def draw_squares(self, canvas, offset, onclick):
     for x in range(self.width):
       xpix = offset.x + x*self.tile_size_px
@@ -607,6 +958,255 @@ class Board:
       self.draw_selection_token(canvas, playernum, xpix, ypix, 7, callback)
 
 
+class CompactBoard:
+  """A compact board for simulations, such as bots searching ahead, that need
+  to clone boards many times. It has the same game logic as Board (get_tile,
+  set_tile, do_player_movement, ...) but none of the drawing.
+
+  Each square is a single byte in cells: 0 if it is empty, otherwise
+  tileid*4 + rotation + 1, which is also the square's row in TILE_EXITS (plus
+  one). Rotations are stored mod 4. The placer of each tile is kept in
+  placeids (-1 if empty), and each token's location as a single int,
+  square index*8 + position, so that copy() only copies two flat arrays and a
+  dict of ints.
+  """
+
+  __slots__ = ('width', 'height', 'cells', 'placeids', 'playerpositions')
+
+  def __init__(self):
+    self.width = BOARD_WIDTH
+    self.height = BOARD_HEIGHT
+    self.cells = bytearray(BOARD_WIDTH * BOARD_HEIGHT)
+    self.placeids = array('l', [-1]) * (BOARD_WIDTH * BOARD_HEIGHT)
+    self.playerpositions = {}
+
+  @classmethod
+  def from_board(cls, board: Board):
+    """Make a compact copy of the state of a Board."""
+    compact = cls()
+
+    for idx, tileid in enumerate(board.tileids):
+      if tileid != None:
+        compact.cells[idx] = tileid*4 + board.tilerotations[idx]%4 + 1
+        compact.placeids[idx] = board.tileplaceids[idx]
+
+    for idnum, (x, y, position) in board.playerpositions.items():
+      compact.update_player_position(idnum, x, y, position)
+
+    return compact
+
+  def copy(self):
+    """Return an independent copy of this board."""
+    board = CompactBoard.__new__(CompactBoard)
+    board.width = self.width
+    board.height = self.height
+    board.cells = self.cells[:]
+    board.placeids = self.placeids[:]
+    board.playerpositions = self.playerpositions.copy()
+    return board
+
+  def reset(self):
+    """Reset the board to be empty, with no tiles or player tokens."""
+    self.cells = bytearray(self.width * self.height)
+    self.placeids = array('l', [-1]) * (self.width * self.height)
+    self.playerpositions = {}
+
+  def get_tile(self, x: int, y: int):
+    """Get (tile id, rotation, placer id) for location x, y."""
+    if x < 0 or x >= self.width:
+      raise Exception('invalid x value')
+    if y < 0 or y >= self.height:
+      raise Exception('invalid y value')
+
+    idx = self.tile_index(x, y)
+    cell = self.cells[idx]
+
+    if not cell:
+      return None, None, None
+
+    tileid, rotation = divmod(cell - 1, 4)
+    return tileid, rotation, self.placeids[idx]
+
+  def set_tile(self, x: int, y: int, tileid: int, rotation: int, idnum: int):
+    """Attempt to place the given tile at position x,y, as Board.set_tile.
+
+    If the tile cannot be placed, returns False, otherwise returns True.
+
+    Note that this does not update the token positions.
+    """
+
+    if idnum in self.playerpositions:
+      playerx, playery, _ = self.get_player_position(idnum)
+      if x != playerx or y != playery:
+        return False
+    elif x != 0 and x != self.width - 1 and y != 0 and y != self.height - 1:
+      return False
+
+    idx = self.tile_index(x, y)
+
+    if self.cells[idx]:
+      return False
+
+    self.cells[idx] = tileid*4 + rotation%4 + 1
+    self.placeids[idx] = idnum
+    return True
+
+  def have_player_position(self, idnum):
+    """Check if the given player (by idnum) has a token on the board."""
+    return idnum in self.playerpositions
+
+  def get_player_position(self, idnum):
+    """The given player (idnum) must have a token on the board before calling
+    this method.
+
+    Returns the player token's location as: x, y, position."""
+    idx, position = divmod(self.playerpositions[idnum], 8)
+    y, x = divmod(idx, self.width)
+    return x, y, position
+
+  def set_player_start_position(self, idnum, x: int, y: int, position: int):
+    """Attempt to set the starting position for a player token, as
+    Board.set_player_start_position. Returns True if the token was placed.
+    """
+    if self.have_player_position(idnum):
+      return False
+
+    # does the tile exist, and does the player own it?
+    idx = self.tile_index(x, y)
+    if not self.cells[idx] or self.placeids[idx] != idnum:
+      return False
+
+    # is position in tile valid?
+    if (position == 0 or position == 1) and y != BOARD_HEIGHT - 1:
+      return False
+    if (position == 2 or position == 3) and x != BOARD_WIDTH - 1:
+      return False
+    if (position == 4 or position == 5) and y != 0:
+      return False
+    if (position == 6 or position == 7) and x != 0:
+      return False
+
+    self.update_player_position(idnum, x, y, position)
+
+    return True
+
+  def do_player_movement(self, live_idnums):
+    """Move the tokens of the players in live_idnums, as
+    Board.do_player_movement. Returns the same (positionupdates, eliminated).
+    """
+    positionupdates = []
+    eliminated = []
+
+    width = self.width
+    cells = self.cells
+    playerpositions = self.playerpositions
+    tile_exits = TILE_EXITS
+    cell_neighbours = CELL_NEIGHBOURS
+
+    for idnum, location in playerpositions.items():
+      # don't keep moving expired players around
+      if not idnum in live_idnums:
+        continue
+
+      idx, position = divmod(location, 8)
+      cell = cells[idx]
+
+      if not cell:
+        continue
+
+      while cell:
+        exitposition = tile_exits[(cell - 1)*8 + position]
+        neighbour = cell_neighbours[idx*8 + exitposition]
+
+        # if that square would be off the board, we're eliminated
+        if neighbour == None:
+          position = exitposition
+          eliminated.append(idnum)
+          break
+
+        idx, position = neighbour
+        cell = cells[idx]
+
+      playerpositions[idnum] = idx*8 + position
+
+      y, x = divmod(idx, width)
+      positionupdates.append(MessageMoveToken(idnum, x, y, position))
+
+    return positionupdates, eliminated
+
+  def legal_tile_moves(self, idnum, hand):
+    """List every tile placement the given player can make from their hand, as
+    Board.legal_tile_moves.
+    """
+    tileids = dict.fromkeys(hand)
+    moves = []
+
+    if idnum in self.playerpositions:
+      idx, position = divmod(self.playerpositions[idnum], 8)
+
+      if not self.cells[idx]:
+        y, x = divmod(idx, self.width)
+        for tileid in tileids:
+          for rotation in range(4):
+            _, _, eliminated = self.trace_token(idx, position, (idx, tileid, rotation))
+            moves.append((tileid, rotation, x, y, eliminated))
+    else:
+      for idx, positions in enumerate(EDGE_POSITIONS):
+        if positions and not self.cells[idx]:
+          y, x = divmod(idx, self.width)
+          for tileid in tileids:
+            for rotation in range(4):
+              moves.append((tileid, rotation, x, y, False))
+
+    return moves
+
+  def legal_start_positions(self, idnum):
+    """List every place the given player can start their token, as
+    Board.legal_start_positions.
+    """
+    moves = []
+
+    if idnum in self.playerpositions:
+      return moves
+
+    for idx, positions in enumerate(EDGE_POSITIONS):
+      if self.placeids[idx] == idnum and self.cells[idx]:
+        y, x = divmod(idx, self.width)
+        for position in positions:
+          _, _, eliminated = self.trace_token(idx, position)
+          moves.append((x, y, position, eliminated))
+
+    return moves
+
+  def tile_index(self, x: int, y :int):
+    return x + y*self.width
+
+  def trace_token(self, idx: int, position: int, placed=None):
+    """Follow the path of a token without moving it, as Board.trace_token."""
+    cells = self.cells
+
+    placedidx = None
+    if placed != None:
+      placedidx, tileid, rotation = placed
+      placedcell = tileid*4 + rotation%4 + 1
+
+    while True:
+      cell = placedcell if idx == placedidx else cells[idx]
+      if not cell:
+        return idx, position, False
+
+      exitposition = TILE_EXITS[(cell - 1)*8 + position]
+      neighbour = CELL_NEIGHBOURS[idx*8 + exitposition]
+
+      if neighbour == None:
+        return idx, exitposition, True
+
+      idx, position = neighbour
+
+  def update_player_position(self, idnum, x: int, y: int, position: int):
+    self.playerpositions[idnum] = self.tile_index(x, y)*8 + position
+
+
 #
 # EVERYTHING BELOW HERE IS PRIVATE OR ONLY NEEDED BY THE CLIENT
 # -------------------------------------------------------------
@@ -709,3 +1309,32 @@ CONNECTION_NEIGHBOURS = [
   (-1,  0,  3),
   (-1,  0,  2)
 ]
+
+
+# Movement lookup tables, built once at import so that do_player_movement is
+# just two list lookups per step.
+#
+# TILE_EXITS[(tileid*4 + rotation)*8 + position] is the position a token
+# entering at position leaves the tile by, i.e. Tile.getmovement (rotations are
+# taken mod 4, as getmovement does).
+#
+# CELL_NEIGHBOURS[idx*8 + exitposition] is (neighbour idx, entry position) for
+# a token leaving board square idx by exitposition, or None if that would take
+# it off the edge of the board.
+#
+# EDGE_POSITIONS[idx] lists the positions on square idx that touch the edge of
+# the board, where a token can start (empty for squares not on the edge).
+
+TILE_EXITS = [tile.getmovement(rotation, position)
+  for tile in ALL_TILES for rotation in range(4) for position in range(8)]
+
+CELL_NEIGHBOURS = [
+  (x+dx + (y+dy)*BOARD_WIDTH, dposition)
+    if 0 <= x+dx < BOARD_WIDTH and 0 <= y+dy < BOARD_HEIGHT else None
+  for y in range(BOARD_HEIGHT) for x in range(BOARD_WIDTH)
+  for dx, dy, dposition in CONNECTION_NEIGHBOURS]
+
+EDGE_POSITIONS = [
+  tuple(position for position, (dx, dy, _) in enumerate(CONNECTION_NEIGHBOURS)
+    if not (0 <= x+dx < BOARD_WIDTH and 0 <= y+dy < BOARD_HEIGHT))
+  for y in range(BOARD_HEIGHT) for x in range(BOARD_WIDTH)]
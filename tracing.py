@@ -0,0 +1,112 @@
+# Spans timing the phases of a turn, written out as a Chrome trace (the JSON
+# array format), which chrome://tracing and https://ui.perfetto.dev can open:
+#
+#   python server.py --trace turns.json
+#
+# Code marks out a phase with
+#
+#   with tracer.span('set_tile', idnum=idnum):
+#       ...
+#
+# While tracing is off that still costs a method call, building its keyword
+# arguments and an empty with block, so a span's arguments should be cheap to
+# work out (an idnum, a len) or left off. Spans are written by the thread that
+# ends them, so only the server's actor should trace
+
+import json
+import os
+import threading
+import time
+
+
+# the span handed out while tracing is off
+class NullSpan():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span():
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+class Tracer():
+    # events written between flushes of the trace file
+    FLUSH_EVERY = 1000
+
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.pid = None
+        self.unflushed = 0
+
+    # start writing spans to a new trace file at path
+    def open(self, path, process_name='server'):
+        self.file = open(path, 'w')
+        self.pid = os.getpid()
+        self.enabled = True
+
+        # names the process in the viewer, and means every event after it can
+        # be written with a comma in front
+        self.file.write('[\n' + json.dumps({'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+            'args': {'name': process_name}}))
+
+    def close(self):
+        self.enabled = False
+        if self.file is not None:
+            self.file.write('\n]\n')
+            self.file.close()
+            self.file = None
+
+    # pause or resume tracing into the open file, flushing it on pause
+    def toggle(self):
+        if self.file is None:
+            return
+
+        self.enabled = not self.enabled
+        if not self.enabled:
+            self.file.flush()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def complete(self, name, start, end, args):
+        if self.file is None:
+            return
+
+        event = {'name': name, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000,
+            'pid': self.pid, 'tid': threading.get_native_id()}
+        if args:
+            event['args'] = args
+
+        self.file.write(',\n' + json.dumps(event))
+
+        self.unflushed += 1
+        if self.unflushed >= self.FLUSH_EVERY:
+            self.file.flush()
+            self.unflushed = 0
+
+
+tracer = Tracer()